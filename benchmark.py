@@ -0,0 +1,234 @@
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import asyncio
+import threading
+import subprocess
+import tempfile
+from shutil import rmtree
+from contextlib import redirect_stdout
+from statistics import median
+
+import main
+from main import commandLineValue, Server, AsyncClient, runConcurrently, clientStreamSync
+from rimlink import generateStructure, compareStructures, hashFile, getAllChildren, HashCache, HashStructure, HASH_ALGORITHMS, MMAP_MIN_SIZE
+from rimlink import encodeManifest, decodeManifest, structureEntries, fileSizes, HashingEngine
+
+# Synthetic installs shaped like a modded RimWorld folder: every mod has About, Defs, Textures, Assemblies and Sounds,
+# with sizes drawn from a log-normal per kind of file. The same seed always gives the same tree, so results can be
+# compared between commits with --compare old.json new.json
+PROFILES = {
+    "tiny" : {"mods" : 5, "files" : 300, "depth" : 3},
+    "small" : {"mods" : 30, "files" : 5000, "depth" : 4},
+    "rimworld" : {"mods" : 300, "files" : 200000, "depth" : 6},
+}
+FILE_KINDS = [ # folder, extension, share of files, median size, sigma
+    ("Defs", ".xml", 0.45, 4*1024, 1.2),
+    ("Textures", ".png", 0.40, 24*1024, 1.5),
+    ("Assemblies", ".dll", 0.05, 96*1024, 1.3),
+    ("Sounds", ".ogg", 0.05, 64*1024, 1.0),
+    ("Languages", ".txt", 0.05, 2*1024, 1.0),
+]
+MAX_FILE_SIZE = 64*1024*1024
+CONTENT_POOL = 8*1024*1024
+
+
+class TreeGenerator:
+    def __init__(self, mods, files, depth, seed=0, size_scale=1.0):
+        assert mods > 0 and files >= mods and depth > 0
+        self.mods = mods
+        self.files = files
+        self.depth = depth
+        self.seed = seed
+        self.size_scale = size_scale
+        self.pool = random.Random(seed).randbytes(CONTENT_POOL) # Files are slices of this at random offsets, much faster than fresh random bytes
+
+    def layout(self): # Yields (relative path, size, content offset) in a fixed order for the seed
+        rng = random.Random(self.seed)
+        for mod in range(self.mods):
+            mod_folder = os.path.join("Mods", "Mod{:04d}".format(mod))
+            yield os.path.join(mod_folder, "About", "About.xml"), 1024, rng.randrange(CONTENT_POOL)
+            for i in range(self.files // self.mods - 1):
+                folder, extension, _, size, sigma = rng.choices(FILE_KINDS, weights=[x[2] for x in FILE_KINDS])[0]
+                parts = [mod_folder, folder] + ["Sub{}".format(rng.randrange(4)) for _ in range(rng.randrange(self.depth))]
+                size = min(int(rng.lognormvariate(0, sigma) * size * self.size_scale), MAX_FILE_SIZE)
+                yield os.path.join(*parts, "{}{}".format(i, extension)), size, rng.randrange(CONTENT_POOL)
+
+    def write(self, location, size, offset):
+        with open(location, "wb") as file:
+            while size:
+                current = self.pool[offset:offset + size]
+                file.write(current)
+                size -= len(current)
+                offset = 0
+
+    def generate(self, location):
+        files = 0
+        total_bytes = 0
+        for relative_path, size, offset in self.layout():
+            path = os.path.join(location, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.write(path, size, offset)
+            files += 1
+            total_bytes += size
+        return {"files" : files, "bytes" : total_bytes}
+
+    def mutate(self, location, changed=0.01, removed=0.01): # Turns a copy into an out of date client: edits, deletions and one missing mod
+        rng = random.Random(self.seed + 1)
+        for relative_path, size, offset in self.layout():
+            path = os.path.join(location, relative_path)
+            roll = rng.random()
+            if roll < changed:
+                self.write(path, max(size // 2, 1), (offset + 1) % CONTENT_POOL)
+            elif roll < changed + removed:
+                os.remove(path)
+        if self.mods > 1:
+            rmtree(os.path.join(location, "Mods", "Mod{:04d}".format(self.mods - 1)))
+
+
+def timed(function, repeat=1):
+    runs = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - t0)
+    return result, runs
+
+def summary(runs, **extra):
+    return dict({"seconds" : median(runs), "runs" : runs}, **extra)
+
+class LoopbackServer: # A real Server on an ephemeral port, the client code reaches it through main.IP_ADDRESS and main.PORT
+    def __init__(self, base_structure):
+        self.loop = asyncio.new_event_loop()
+        self.server = Server()
+        self.server.base_structure = base_structure
+        self.server.base_app_data_structure = base_structure
+        started = threading.Event()
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            self.listener = self.loop.run_until_complete(asyncio.start_server(self.server._handle_client, "127.0.0.1", 0))
+            started.set()
+            self.loop.run_forever()
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        main.IP_ADDRESS, main.PORT = self.listener.sockets[0].getsockname()[:2]
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.listener.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+def loopbackSync(host_structure, client_location):
+    server = LoopbackServer(host_structure)
+    try:
+        mine = generateStructure(client_location)
+        differences, = runConcurrently(AsyncClient().differences(b"\x03", mine, HashStructure(client_location, isfile=False, defer_hash=True)))
+        wanted_bytes = sum(x.size for x in differences['add'] + differences['modify'] if x.file)
+        failed = clientStreamSync([(b"\x03", mine, HashStructure(client_location, isfile=False, defer_hash=True))]) # The default client path, comparison and downloads overlapped
+        return wanted_bytes, failed
+    finally:
+        server.close()
+
+def runBenchmarks(location, generator, repeat=3):
+    host = os.path.join(location, "host")
+    client = os.path.join(location, "client")
+    results = {}
+    tree, runs = timed(lambda: generator.generate(host))
+    results["generate_tree"] = summary(runs)
+    generator.generate(client)
+    generator.mutate(client)
+
+    paths = [x.path() for x in getAllChildren(generateStructure(host)) if x.file]
+    _, runs = timed(lambda: [hashFile(x) for x in paths], repeat)
+    results["hash_file"] = summary(runs, mb_per_second=tree["bytes"] / 1e6 / median(runs))
+    large = [x for x in paths if os.path.getsize(x) >= MMAP_MIN_SIZE] or paths # Read paths only differ for large files
+    large_bytes = sum(os.path.getsize(x) for x in large)
+    for algorithm in HASH_ALGORITHMS:
+        for read_path, use_mmap in (("readinto", False), ("mmap", True)):
+            _, runs = timed(lambda: [hashFile(x, algorithm, use_mmap) for x in large], repeat)
+            results["hash_{}_{}".format(algorithm, read_path)] = summary(runs, files=len(large), mb_per_second=large_bytes / 1e6 / median(runs))
+
+    _, runs = timed(lambda: generateStructure(host), repeat)
+    results["generate_structure"] = summary(runs, files_per_second=tree["files"] / median(runs))
+    cache = HashCache(os.path.join(location, "hashes.cache"))
+    generateStructure(host, hash_cache=cache)
+    _, runs = timed(lambda: generateStructure(host, hash_cache=cache), repeat)
+    results["generate_structure_cached"] = summary(runs, files_per_second=tree["files"] / median(runs))
+
+    host_structure = generateStructure(host)
+    client_structure = generateStructure(client)
+    engine = HashingEngine()
+    _, runs = timed(lambda: generateStructure(client, hashing_engine=engine, expected_sizes=fileSizes(host_structure)), repeat)
+    results["lazy_scan"] = summary(runs, files_hashed=engine.files_hashed // repeat, files_settled=engine.files_settled // repeat) # No hash cache, so every file the host has at the same size is hashed
+    differences, runs = timed(lambda: compareStructures(host_structure, client_structure), repeat)
+    results["compare_structures"] = summary(runs, **{x : len(y) for x, y in differences.items()})
+
+    manifest, runs = timed(lambda: b"".join(encodeManifest(structureEntries(host_structure), host_structure.digest)), repeat)
+    results["manifest_encode"] = summary(runs, bytes=len(manifest))
+    _, runs = timed(lambda: decodeManifest(manifest), repeat)
+    results["manifest_decode"] = summary(runs)
+
+    (wanted_bytes, failed), runs = timed(lambda: loopbackSync(host_structure, client)) # Only once, the sync changes the client
+    results["loopback_sync"] = summary(runs, bytes=wanted_bytes, mb_per_second=wanted_bytes / 1e6 / runs[0], failed=len(failed))
+    return {"tree" : tree, "results" : results}
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compareReports(old, new): # Prints how every timing moved between two saved reports
+    print("{:<28}{:>12}{:>12}{:>9}".format("benchmark", "old (s)", "new (s)", "change"))
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        before = old["results"][name]["seconds"]
+        after = result["seconds"]
+        print("{:<28}{:>12.4f}{:>12.4f}{:>+8.1%}".format(name, before, after, after / before - 1 if before else 0))
+
+def benchmark(cmdLine=sys.argv):
+    if "--compare" in cmdLine:
+        index = cmdLine.index("--compare")
+        with open(cmdLine[index + 1]) as old, open(cmdLine[index + 2]) as new:
+            return compareReports(json.load(old), json.load(new))
+    profile = commandLineValue("--profile", "small", cmdLine)
+    config = dict(PROFILES[profile])
+    for name in ("mods", "files", "depth"):
+        config[name] = int(commandLineValue("--" + name, config[name], cmdLine))
+    config["seed"] = int(commandLineValue("--seed", 0, cmdLine))
+    config["size_scale"] = float(commandLineValue("--sizescale", 1.0, cmdLine))
+    repeat = int(commandLineValue("--repeat", 3, cmdLine))
+    location = tempfile.mkdtemp(prefix="rimlink-benchmark-", dir=commandLineValue("--workdir", None, cmdLine))
+    try:
+        with redirect_stdout(sys.stderr): # Progress printed by the client and server must not end up in the JSON
+            report = runBenchmarks(location, TreeGenerator(**config), repeat)
+    finally:
+        rmtree(location, ignore_errors=True)
+    report.update({
+        "commit" : gitCommit(),
+        "profile" : profile,
+        "config" : config,
+        "repeat" : repeat,
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "cpus" : os.cpu_count(),
+    })
+    output = commandLineValue("--output", None, cmdLine)
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -5,18 +5,56 @@ import re
 import os
 import time
 import sys # for sys.argv command line arguments
-import pickle
 import socket
-from shutil import rmtree
+import struct
+from shutil import rmtree, copyfile
 import traceback
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+import multiprocessing
 
-from rimlink import generateStructure, compareStructures, AppDataStructure, isAdmin, FileFolder
+from rimlink import generateStructure, compareStructures, AppDataStructure, isAdmin, HashCache, HashingEngine
+from rimlink import HashStructure, ManifestReader, encodeManifest, structureEntries, differenceEntries, structureFromManifest, ManifestError, MANIFEST_CHUNK
+from rimlink import manifestEntry, structureIndex, partitionBySize, newHash, PART_SUFFIX
+from rimlink import portablePath, validManifestPath, deltaBlockSize, blockSignatures, computeDelta, applyDelta, DELTA_MIN_SIZE, DELTA_SIGNATURE
+from rimlink import CompressionStats, chooseCodec, shouldCompress, COMPRESSION_CODECS, DiffCache
+from rimlink import rescanStructure, TreeWatcher, watchBackend, getAllChildren, TransferJournal, RESUME_MIN_SIZE, Metrics
+from rimlink import HASH_ALGORITHMS, setHashAlgorithm, checkManifestAlgorithm, TokenBucket, iterDifferences, ManifestTree, fileSizes, UNHASHED
+import rimlink
+import tempfile
+import json
 
 
 
 PORT = 5002
 IP_ADDRESS = None
 
+AREA_GAME = 0 # Which of the host's structures a batched file request is for
+AREA_CONFIG = 1
+FILE_HEADER = struct.Struct(">BQ") # status, size. Precedes every file in a batched response
+FILE_SENT = 0
+FILE_MISSING = 1
+FILE_CHUNK = 1024*1024
+WRITE_BUFFER_LIMIT = 1024*1024 # Per connection, writers wait in drain() once this much is queued
+RECEIVE_BUFFER = 1024*1024
+DELTA_PATH = struct.Struct(">H") # path length of a delta request, 0 ends the requests
+RANGE_OFFSET = struct.Struct(">Q") # Follows the path of a ranged request
+RANGE_HEADER = struct.Struct(">BQQ") # status, size, offset the host starts from. Precedes every file in a ranged response
+DELTA_SOURCE = struct.Struct(">QII") # size of the client's copy, block size, signature count
+DELTA_VALUE = struct.Struct(">I") # block index after a b"C" instruction, data length after a b"D" instruction
+DELTA_MAX_BLOCK = 1024*1024
+DELTA_MAX_SIGNATURES = 1 << 22
+FRAME = struct.Struct(">I") # length of one compressed frame, 0 ends the stream
+MAX_FRAME = 1024*1024
+HELLO_LIMIT = 64*1024
+DELTA_BATCH = 256 # Delta instructions worked out per trip to the executor
+APPLY_WORKERS = 16 # Threads deleting and making folders on the client, the work is waiting on the disk rather than the CPU
+ENCODING_RAW = 0 # Follows the file header of a batched response when compression was asked for
+ENCODING_FRAMES = 1
+COMPRESSION_STATS = CompressionStats() # Client side totals
+CLIENT_METRICS = Metrics()
+
 def yesNoValidator(obj):
     if obj in ["y", "n"]:
         return True
@@ -54,57 +92,784 @@ def requireRimworldFolder():
     return True
 
 
+def commandLineValue(name, default=None, cmdLine=sys.argv):
+    if name in cmdLine:
+        return cmdLine[cmdLine.index(name)+1]
+    return default
+
+def hashingEngine():
+    backend = commandLineValue("--hashbackend", "thread")
+    workers = int(commandLineValue("--hashworkers", 0)) or None
+    batch_size = int(commandLineValue("--hashbatch", 64))
+    return HashingEngine(backend, workers, batch_size)
+
+def comparisonExecutor():
+    backend = commandLineValue("--comparebackend", "thread")
+    assert backend in HashingEngine.BACKENDS, "Unknown comparison backend {}".format(backend)
+    workers = int(commandLineValue("--compareworkers", 0)) or None
+    return HashingEngine.BACKENDS[backend](max_workers=workers)
+
+# The host's CPU heavy steps. Module level so a process pool can run them, everything they need is passed in
+def manifestDifferenceChunks(base, entries, root_digest, algorithm): # Encoded differences in walk order, a chunk at a time as the comparison finds them
+    other_structure = structureFromManifest(entries, HashStructure(".", isfile=False, defer_hash=True), root_digest)
+    return encodeManifest(differenceEntries(iterDifferences(base, other_structure)), algorithm=algorithm)
+
+def manifestDifferences(base, entries, root_digest, algorithm):
+    return b"".join(manifestDifferenceChunks(base, entries, root_digest, algorithm))
+
+def structureManifest(base, algorithm):
+    return b"".join(encodeManifest(structureEntries(base), base.digest, algorithm=algorithm))
+
+def nextChunk(chunks):
+    return next(chunks, None)
+
+def deltaBatch(instructions): # Up to DELTA_BATCH instructions, fewer once their literal data reaches FILE_CHUNK so a rewritten file is not held in memory
+    batch = []
+    literal_bytes = 0
+    for kind, value in instructions:
+        batch.append((kind, value))
+        if kind == "data":
+            literal_bytes += len(value)
+        if len(batch) >= DELTA_BATCH or literal_bytes >= FILE_CHUNK:
+            break
+    return batch
+
+async def asyncChunks(chunks): # Plain and async iterables consumed the same way
+    if hasattr(chunks, "__aiter__"):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
+
+def reportHashCache(hash_cache):
+    hash_cache.save()
+    print("{} files hashed, {} reused from the hash cache".format(hash_cache.misses, hash_cache.hits))
+
+def reportMetrics(metrics):
+    snapshot = metrics.snapshot()
+    for name, histogram in sorted(snapshot["histograms"].items()):
+        if histogram["count"]:
+            print("{}: {} in total over {}, p50 {:.3f} p99 {:.3f}".format(name, round(histogram["sum"], 3), histogram["count"], histogram["p50"], histogram["p99"]))
+    location = commandLineValue("--metricsdump", None)
+    if location:
+        metrics.dump(location)
+
 def hangForever():
     print("Execution complete.")
     while True:
         time.sleep(120)
 
+def deltaCandidate(fileObj): # Big enough on both sides that sending block signatures beats sending the file
+    if not fileObj.file or fileObj.size < DELTA_MIN_SIZE:
+        return False
+    try:
+        return os.path.isfile(fileObj.path()) and os.path.getsize(fileObj.path()) >= DELTA_MIN_SIZE
+    except OSError:
+        return False
+
+class DedupPlan: # Groups wanted files by content so each unique blob is fetched at most once, and not at all if a local file already has it
+    # --confirm adds every wanted file up front, streaming asks through want as differences arrive. Both stage local sources before they go
+    def __init__(self, wanted=(), local_structures=(), hardlinks=False):
+        self.hardlinks = hardlinks
+        self.groups = {} # hash -> files wanting that content
+        self.unique = [] # Files without a usable hash, fetched as they are
+        for fileObj in wanted:
+            if self.digest(fileObj) is not None:
+                self.groups.setdefault(fileObj.hash, []).append(fileObj)
+            else:
+                self.unique.append(fileObj)
+        self.local = {} # hash -> path of a local file that already has it
+        self.sources = {} # key of each path in local -> its hash
+        self.roots = {} # hash -> root of the structure its source came from, staged copies go in there
+        for structure in local_structures:
+            for x in getAllChildren(structure):
+                digest = self.digest(x)
+                if x.file and digest is not None and digest not in self.local:
+                    self.local[digest] = x.path()
+                    self.sources[ApplyPlan.key(x.path())] = digest
+                    self.roots[digest] = structure.path()
+        self.staging = {} # root -> staging folder
+        self.files_copied = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def digest(fileObj):
+        if fileObj.hash and fileObj.hash not in ("permission_denied", UNHASHED):
+            return fileObj.hash
+        return None
+
+    def stage(self, leaving, later=False): # Local sources about to be deleted or overwritten are linked (or copied) aside first
+        # later: not every wanted file is known yet, so sources nobody wants so far are kept too if a hardlink will do
+        keys = []
+        folders = set()
+        for path in leaving:
+            key = ApplyPlan.key(path)
+            if key in self.sources:
+                keys.append(key)
+            elif os.path.isdir(path) and not os.path.islink(path):
+                folders.add(key)
+        if folders:
+            keys.extend(x for x in self.sources if ApplyPlan.inside(x, folders))
+        for key in keys:
+            digest = self.sources.pop(key, None)
+            source = self.local.pop(digest, None)
+            if source is None: # Named twice, or dropped already
+                continue
+            wanted = digest in self.groups
+            if not wanted and not later:
+                continue
+            root = self.roots[digest]
+            if root not in self.staging:
+                self.staging[root] = tempfile.mkdtemp(suffix=PART_SUFFIX, dir=root)
+            staged = os.path.join(self.staging[root], digest)
+            try:
+                os.link(source, staged)
+            except OSError:
+                if not wanted:
+                    continue
+                try:
+                    copyfile(source, staged)
+                except OSError:
+                    continue
+            self.local[digest] = staged
+
+    def forget(self, digest):
+        source = self.local.pop(digest, None)
+        if source is not None:
+            self.sources.pop(ApplyPlan.key(source), None)
+
+    def downloads(self):
+        return [x[0] for digest, x in self.groups.items() if digest not in self.local] + self.unique
+
+    def want(self, fileObj, hash_cache=None): # Streaming: copies straight away if the content is here, returns whether the file has to be downloaded
+        digest = self.digest(fileObj)
+        if digest is None:
+            return True
+        source = self.local.get(digest, None)
+        if source is not None:
+            if self.copy(source, fileObj, self.hardlinks):
+                self.copied(fileObj, hash_cache)
+                return False
+            self.forget(digest) # Changed since it was scanned
+        group = self.groups.setdefault(digest, [])
+        group.append(fileObj)
+        return len(group) == 1 # The rest are filled from the first once it is in
+
+    @staticmethod
+    def copy(source, fileObj, hardlinks=False):
+        part_name = fileObj.path() + PART_SUFFIX
+        if hardlinks:
+            try:
+                os.link(source, part_name)
+                os.replace(part_name, fileObj.path())
+                return True
+            except OSError:
+                if os.path.exists(part_name):
+                    os.remove(part_name)
+        hasher = newHash()
+        try:
+            with open(source, "rb") as src, open(part_name, "wb") as dst: # Checked against the manifest like a download
+                for chunk in iter(lambda: src.read(RECEIVE_BUFFER), b""):
+                    hasher.update(chunk)
+                    dst.write(chunk)
+        except OSError:
+            if os.path.exists(part_name):
+                os.remove(part_name)
+            return False
+        return Server.clientFinishPart(fileObj, part_name, hasher)
+
+    def copied(self, fileObj, hash_cache=None):
+        self.files_copied += 1
+        self.bytes_saved += fileObj.size
+        if hash_cache is not None:
+            hash_cache.store(fileObj.path(), os.stat(fileObj.path()), fileObj.hash)
+
+    def fill(self, scheduler): # Run after the downloads, copies each blob from wherever it now is to the files still missing it
+        failed = set(map(id, scheduler.failed))
+        for digest, group in self.groups.items():
+            source = self.local.get(digest, None)
+            targets = group
+            if source is None:
+                if id(group[0]) in failed:
+                    scheduler.failed.extend(group[1:])
+                    continue
+                source = group[0].path()
+                targets = group[1:]
+            for fileObj in targets:
+                if self.copy(source, fileObj, self.hardlinks):
+                    self.copied(fileObj, scheduler.hash_cache)
+                else:
+                    scheduler.failed.append(fileObj)
+        for folder in self.staging.values():
+            rmtree(folder, ignore_errors=True)
+        self.staging = {}
+
+class ApplyPlan: # Local changes in waves: deletes, then folders, then files. Nothing inside a wave depends on anything else in it, so each runs on a pool
+    def __init__(self, workers=None):
+        self.workers = workers or int(commandLineValue("--applyworkers", 0)) or APPLY_WORKERS
+
+    @staticmethod
+    def key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def parallel(self, function, items):
+        if len(items) <= 1 or self.workers == 1:
+            return [function(x) for x in items]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as executor:
+            return list(executor.map(function, items))
+
+    @staticmethod
+    def remove(path): # Checks the disk rather than the node, a modified entry may have changed between file and folder
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            print("Failed to delete {} for some reason".format(path))
+
+    @staticmethod
+    def inside(key, folders): # Whether any folder above key is one of folders
+        parent = os.path.dirname(key)
+        while parent not in folders:
+            key, parent = parent, os.path.dirname(parent)
+            if parent == key:
+                return False
+        return True
+
+    def delete(self, nodes): # Anything inside a folder that is going anyway is left to that folder's rmtree
+        folders = {self.key(x.path()) for x in nodes if not x.file}
+        outermost = [x.path() for x in nodes if not self.inside(self.key(x.path()), folders)]
+        with CLIENT_METRICS.timer("delete_seconds"):
+            self.parallel(self.remove, outermost)
+
+    @staticmethod
+    def makeFolder(path):
+        os.makedirs(path, exist_ok=True)
+
+    def makeFolders(self, nodes): # Only the deepest new folders are made, makedirs fills in the ones above them
+        folders = [x.path() for x in nodes if not x.file]
+        has_subfolders = {os.path.dirname(self.key(x)) for x in folders}
+        with CLIENT_METRICS.timer("mkdir_seconds"):
+            self.parallel(self.makeFolder, [x for x in folders if self.key(x) not in has_subfolders])
+
+def kindChanged(structure): # A file on disk where the host has a folder or the other way round, the old one has to go first
+    path = structure.path()
+    return os.path.lexists(path) and (os.path.isdir(path) and not os.path.islink(path)) == structure.file
+
 def clientSyncFiles(to_delete, to_add, to_modify, **kwargs):
-    to_delete.extend(to_modify)
-    to_add.extend(to_modify)
     testing = kwargs.get("testing", None)
+    to_patch = [] if testing else [x for x in to_modify if deltaCandidate(x)]
+    patching = set(map(id, to_patch))
+    to_modify = [x for x in to_modify if id(x) not in patching]
+    clashing = [x for x in to_modify if kindChanged(x)]
+    clashing_ids = set(map(id, clashing))
+    to_delete.extend(clashing) # Files are replaced in place once verified, so a failed download leaves the old copy
+    to_add.extend(to_modify)
+    plan = None
+    if not testing:
+        plan = DedupPlan([x for x in to_add if x.file], kwargs.get("local_structures", ()), "--hardlinks" in sys.argv)
+        plan.stage([x.path() for x in to_delete] + [x.path() for x in to_modify if id(x) not in clashing_ids] + [x.path() for x in to_patch])
     del to_modify
-    folders = []
-    for delete in to_delete:
-        if not delete.file:
-            folders.append(delete)
-        else:
-            os.remove(delete.path())
-    folders.sort(reverse=True, key=lambda x: x.path().count("\\"))
-    for folder in folders:
-        try:
-            rmtree(folder.path())
-        except:
-            print("Failed to delete {} for some reason".format(folder.path()))
-
-    folders = []
-    for add in to_add:
-        if not add.file:
-            folders.append(add)
-    folders.sort(key=lambda x: x.path().count("\\"))
-    for folder in folders:
-        to_add.remove(folder)
-        os.mkdir(folder.path())
-
-    i = 0
+    apply = ApplyPlan(kwargs.get("apply_workers", None))
+    apply.delete(to_delete)
+    apply.makeFolders(to_add)
+    to_add = [x for x in to_add if x.file]
+
     if testing:
         tests = []
-    for file_name in to_add:
-        if testing:
+        for file_name in to_add:
             tests.append(file_name)
             print("Downloaded {}".format(file_name))
-            continue
-        s = socket.socket()
-        s.connect((IP_ADDRESS, PORT))
-        Server.clientRecieveFile(s, file_name)
-        s.close()
-        i += 1
-        if i % 100 == 0:
-            print("{} files downloaded...".format(i))
-    print("Done syncing files")
-    if testing:
         return tests
-    # Server.clientSendString(s, to_add)
+    scheduler = DownloadScheduler(kwargs.get("connections", None) or int(commandLineValue("--connections", 4)), kwargs.get("hash_cache", None), kwargs.get("codec", None), kwargs.get("journal", None))
+    if to_patch:
+        scheduler.run(to_patch, scheduler.downloadDeltas)
+        failed_deltas = scheduler.failed # Falls back to a full transfer, the old copy is still in place until that finishes
+        scheduler.failed = []
+        print("Delta transfer saved {:.1f} MB on {} files".format(scheduler.bytes_saved / 1e6, scheduler.delta_files))
+    else:
+        failed_deltas = []
+    scheduler.run(plan.downloads() + failed_deltas)
+    plan.fill(scheduler)
+    if plan.files_copied:
+        print("{} duplicate files ({:.1f} MB) filled in locally instead of downloaded".format(plan.files_copied, plan.bytes_saved / 1e6))
+    if scheduler.failed:
+        print("{} files did not match the host's copy and were left out: {}".format(len(scheduler.failed), ", ".join(x.relativePath() for x in scheduler.failed)))
+    print("Done syncing files")
+    return scheduler.failed
+
+def fileArea(structure):
+    if isinstance(structure, AppDataStructure):
+        return AREA_CONFIG
+    return AREA_GAME
+
+class DownloadScheduler: # Spreads files over several connections by size, folders must already exist
+    def __init__(self, connections=4, hash_cache=None, codec=None, journal=None):
+        assert connections > 0
+        self.connections = connections
+        self.hash_cache = hash_cache
+        self.codec = codec
+        self.journal = journal
+        self.files_done = 0
+        self.bytes_done = 0
+        self.delta_files = 0
+        self.bytes_saved = 0
+        self.files_resumed = 0
+        self.bytes_resumed = 0
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def progress(self, fileObj, file_size, verified=True, bytes_transferred=None, resumed=False):
+        with self.lock:
+            if not verified:
+                self.failed.append(fileObj)
+                return
+            if self.hash_cache is not None and fileObj.hash:
+                self.hash_cache.store(fileObj.path(), os.stat(fileObj.path()), fileObj.hash) # Already verified while recieving, no need to hash it again next run
+            if bytes_transferred is None:
+                bytes_transferred = file_size
+            elif resumed:
+                self.files_resumed += 1
+                self.bytes_resumed += file_size - bytes_transferred
+            else:
+                self.delta_files += 1
+                self.bytes_saved += file_size - bytes_transferred
+            self.files_done += 1
+            self.bytes_done += bytes_transferred
+            if self.files_done % 100 == 0:
+                print("{} files downloaded...".format(self.files_done))
+                if self.hash_cache is not None: # An interrupted sync then does not have to hash what it already downloaded
+                    self.hash_cache.save()
+
+    async def download(self, fileObjs):
+        client = AsyncClient(self.codec, self.journal)
+        requests = []
+        for area in (AREA_GAME, AREA_CONFIG):
+            wanted = [x for x in fileObjs if fileArea(x) == area]
+            if self.journal is not None: # Parts left by an interrupted run only need the rest of the file
+                offsets = [self.journal.offset(x.path() + PART_SUFFIX, x.hash, x.size) for x in wanted]
+                ranges = [(x, offset) for x, offset in zip(wanted, offsets) if offset]
+                wanted = [x for x, offset in zip(wanted, offsets) if not offset]
+                if ranges:
+                    requests.append(client.recieveRanges(ranges, area, self.progress))
+            if wanted:
+                requests.append(client.recieveFiles(wanted, area, self.progress))
+        await asyncio.gather(*requests)
+
+    def downloadDeltas(self, fileObjs): # Blocking, signatures and patching are file work anyway so these run on threads
+        for area in (AREA_GAME, AREA_CONFIG):
+            wanted = [x for x in fileObjs if fileArea(x) == area]
+            if not wanted:
+                continue
+            s = socket.socket()
+            s.connect((IP_ADDRESS, PORT))
+            try:
+                Server.clientRecieveDeltas(s, wanted, area, self.progress)
+            finally:
+                s.close()
+
+    def run(self, fileObjs, download=None):
+        partitions = partitionBySize(fileObjs, self.connections)
+        t0 = time.time()
+        try:
+            if download:
+                with ThreadPoolExecutor(max_workers=len(partitions) or 1) as executor:
+                    for future in [executor.submit(download, x) for x in partitions]:
+                        future.result()
+            else: # One event loop drives every connection, each partition is its own request
+                runConcurrently(*[self.download(x) for x in partitions])
+        finally:
+            if self.hash_cache is not None:
+                self.hash_cache.save()
+        elapsed = time.time() - t0
+        if self.files_resumed:
+            print("Resumed {} interrupted files, {:.1f} MB were already on disk".format(self.files_resumed, self.bytes_resumed / 1e6))
+        if self.files_done:
+            print("Downloaded {} files ({:.1f} MB) in {:.1f}s over {} connections, {:.2f} MB/s".format(self.files_done, self.bytes_done / 1e6, elapsed, len(partitions), self.bytes_done / 1e6 / max(elapsed, 1e-6)))
+
+class StreamingSync: # Applies differences while they are still arriving. Each chunk is applied on a worker thread and its downloads start straight away, deletes wait until the end
+    BATCH_FILES = 256 # A batch also ends with every chunk of differences recieved
+    BATCH_BYTES = 64*1024*1024
+
+    def __init__(self, connections=4, hash_cache=None, codec=None, journal=None, local_structures=(), hardlinks=False):
+        self.scheduler = DownloadScheduler(connections, hash_cache, codec, journal)
+        self.plan = DedupPlan((), local_structures, hardlinks)
+        self.apply = ApplyPlan()
+        self.worker = ThreadPoolExecutor(max_workers=1) # Chunks are applied one at a time, in the order they arrived
+        self.slots = asyncio.Semaphore(connections)
+        self.to_delete = []
+        self.to_patch = []
+        self.written = set() # Keys of every path written and the folders above them
+        self.batch = []
+        self.batch_bytes = 0
+        self.tasks = []
+        self.entries = 0
+
+    key = staticmethod(ApplyPlan.key) # Case-insensitive file systems see Foo.xml and foo.xml as one file
+
+    def markWritten(self, path):
+        path = self.key(path)
+        while path not in self.written:
+            self.written.add(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    def applyChunk(self, pairs): # On the worker thread, returns the files of the chunk that have to be downloaded. Its new folders are made in one wave before its files
+        folders = []
+        files = []
+        for entry, node in pairs:
+            self.entries += 1
+            if entry.section == "delete":
+                self.to_delete.append(node)
+            elif not node.file:
+                folders.append(node)
+            elif entry.section == "modify" and deltaCandidate(node): # Needs the old copy, patched once everything else is in
+                self.to_patch.append(node)
+            else:
+                files.append(node)
+        clashing = [x for x in folders + files if kindChanged(x)]
+        self.plan.stage([x.path() for x in clashing + files], later=True) # Sources inside anything cleared or overwritten are kept aside
+        self.apply.delete(clashing)
+        self.apply.makeFolders(folders)
+        for node in folders + files:
+            self.markWritten(node.path())
+        return [x for x in files if self.plan.want(x, self.scheduler.hash_cache)]
+
+    async def feed(self, pairs): # Called with each chunk of differences on the event loop
+        for fileObj in await asyncio.get_running_loop().run_in_executor(self.worker, self.applyChunk, pairs):
+            self.batch.append(fileObj)
+            self.batch_bytes += fileObj.size
+            if len(self.batch) >= self.BATCH_FILES or self.batch_bytes >= self.BATCH_BYTES:
+                self.flush()
+        self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.tasks.append(asyncio.ensure_future(self.fetch(self.batch)))
+            self.batch = []
+            self.batch_bytes = 0
+
+    async def fetch(self, batch):
+        async with self.slots:
+            await self.scheduler.download(batch)
+
+    async def drain(self): # Once the differences have all arrived
+        self.flush()
+        await asyncio.gather(*self.tasks)
+
+    def finish(self): # After the event loop: duplicates, then deltas, then deletes
+        self.worker.shutdown()
+        self.plan.fill(self.scheduler)
+        if self.to_patch:
+            failed = self.scheduler.failed
+            self.scheduler.failed = []
+            self.scheduler.run(self.to_patch, self.scheduler.downloadDeltas)
+            retry = self.scheduler.failed # Falls back to a full transfer
+            self.scheduler.failed = failed
+            print("Delta transfer saved {:.1f} MB on {} files".format(self.scheduler.bytes_saved / 1e6, self.scheduler.delta_files))
+            if retry:
+                self.scheduler.run(retry)
+        self.apply.delete([x for x in self.to_delete if self.key(x.path()) not in self.written]) # Anything written was replaced already, only the case of its name differed
+
+def clientStreamSync(comparisons, **kwargs): # comparisons hold (opcode, local structure, root) per area. Downloads start with the first differences
+    # Differences already worked out on this side, as from a lazy scan, come in through local_differences as lists of (entry, node) pairs
+    local_structures = kwargs.get("local_structures", None) or [x[1] for x in comparisons]
+    sync = StreamingSync(kwargs.get("connections", None) or int(commandLineValue("--connections", 4)), kwargs.get("hash_cache", None), kwargs.get("codec", None), kwargs.get("journal", None), local_structures, "--hardlinks" in sys.argv)
+    async def stream():
+        client = AsyncClient(sync.scheduler.codec, sync.scheduler.journal)
+        async def consume(opcode, structure, root):
+            async for pairs in client.streamDifferences(opcode, structure, root):
+                await sync.feed(pairs)
+        for pairs in kwargs.get("local_differences", ()):
+            await sync.feed(pairs)
+        await asyncio.gather(*[consume(*x) for x in comparisons])
+        await sync.drain()
+    t0 = time.time()
+    try:
+        asyncio.run(stream())
+    finally:
+        if sync.scheduler.hash_cache is not None:
+            sync.scheduler.hash_cache.save()
+    sync.finish()
+    scheduler = sync.scheduler
+    elapsed = time.time() - t0
+    print("{} differences, {} files ({:.1f} MB) downloaded and {} filled in locally in {:.1f}s".format(sync.entries, scheduler.files_done, scheduler.bytes_done / 1e6, sync.plan.files_copied, elapsed))
+    if scheduler.files_resumed:
+        print("Resumed {} interrupted files, {:.1f} MB were already on disk".format(scheduler.files_resumed, scheduler.bytes_resumed / 1e6))
+    if scheduler.failed:
+        print("{} files did not match the host's copy and were left out: {}".format(len(scheduler.failed), ", ".join(x.relativePath() for x in scheduler.failed)))
+    print("Done syncing files")
+    return scheduler.failed
+
+def lazyDifferences(host_structure, structure): # (entry, node) pairs as the host would have streamed them, worked out against its file list
+    return [(manifestEntry(node, section), node) for section, node in iterDifferences(host_structure, structure)]
+
+def runConcurrently(*coroutines): # Runs the coroutines side by side on a fresh event loop, returns their results in order
+    async def gathered():
+        return await asyncio.gather(*coroutines)
+    return asyncio.run(gathered())
+
+class ClientConnection: # A non-blocking socket driven by the event loop. Unlike a StreamReader it recieves straight into the caller's buffer
+    def __init__(self, sock):
+        self.sock = sock
+        self.loop = asyncio.get_running_loop()
+
+    @classmethod
+    async def open(cls, host, port):
+        loop = asyncio.get_running_loop()
+        family, kind, proto, _, address = (await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM))[0]
+        sock = socket.socket(family, kind, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+        return cls(sock)
+
+    async def send(self, data):
+        await self.loop.sock_sendall(self.sock, data)
+
+    async def recvInto(self, view): # 0 once the host has closed the connection
+        return await self.loop.sock_recv_into(self.sock, view)
+
+    async def read(self, size):
+        return await self.loop.sock_recv(self.sock, size)
+
+    async def readExactly(self, length):
+        data = bytearray(length)
+        view = memoryview(data)
+        bytes_got = 0
+        while bytes_got < length:
+            current = await self.recvInto(view[bytes_got:])
+            if not current:
+                raise ConnectionResetError("Connection closed after {} of {} bytes".format(bytes_got, length))
+            bytes_got += current
+        return data
+
+    def close(self):
+        self.sock.close()
+
+class AsyncClient: # The client side of the protocol on the event loop. Every request opens its own connection, so any number of them can be in flight
+    def __init__(self, codec=None, journal=None):
+        self.codec = codec
+        self.journal = journal
+
+    async def request(self, opcode, codec=None): # Requests that support compression are prefixed with \x08 and the codec name
+        connection = await ClientConnection.open(IP_ADDRESS, PORT)
+        try:
+            if codec:
+                name = codec.encode("ascii")
+                opcode = b"\x08" + bytes([len(name)]) + name + opcode
+            await connection.send(opcode)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    async def recieveReply(self, connection, limit=None): # One length prefixed JSON document
+        length = FRAME.unpack(await connection.readExactly(FRAME.size))[0]
+        if limit is not None and length > limit:
+            raise ConnectionResetError("Oversized reply from host")
+        return json.loads(await connection.readExactly(length))
+
+    async def hello(self, capabilities): # Tells the host what this client supports, the host answers with what it picked
+        hello = json.dumps(capabilities).encode()
+        connection = await self.request(b"\x07" + FRAME.pack(len(hello)) + hello)
+        try:
+            return await self.recieveReply(connection, HELLO_LIMIT)
+        finally:
+            connection.close()
+
+    async def stats(self): # The host's metrics as a dict
+        connection = await self.request(b"\x0a")
+        try:
+            return await self.recieveReply(connection)
+        finally:
+            connection.close()
+
+    @staticmethod
+    async def sendFrameData(connection, data):
+        for i in range(0, len(data), MAX_FRAME):
+            await connection.send(FRAME.pack(len(data[i:i + MAX_FRAME])) + data[i:i + MAX_FRAME])
+
+    async def sendFrames(self, connection, chunks): # Each chunk goes out as soon as it is compressed
+        compressor = COMPRESSION_STATS.compressor(self.codec)
+        for chunk in chunks:
+            await self.sendFrameData(connection, compressor.compress(chunk))
+        await self.sendFrameData(connection, compressor.flush())
+        await connection.send(FRAME.pack(0))
+
+    async def recieveFrames(self, connection): # Yields decompressed data until the empty frame that ends the stream
+        decompressor = COMPRESSION_STATS.decompressor(self.codec)
+        while True:
+            length = FRAME.unpack(await connection.readExactly(FRAME.size))[0]
+            if length == 0:
+                return
+            if length > MAX_FRAME:
+                raise ConnectionResetError("Oversized frame of {} bytes".format(length))
+            for current in decompressor.decompress(await connection.readExactly(length)):
+                yield current
+
+    async def sendManifestEntries(self, connection, entries, root_digest=None):
+        chunks = encodeManifest(entries, root_digest)
+        if self.codec:
+            return await self.sendFrames(connection, chunks)
+        for chunk in chunks:
+            await connection.send(chunk)
+
+    async def recieveManifestChunks(self, connection, manifest_reader=None): # Yields the entries of each chunk as it arrives
+        manifest_reader = manifest_reader or ManifestReader()
+        def feed(current):
+            entries = manifest_reader.feed(current)
+            if manifest_reader.algorithm is not None: # Known once the header is in, before any entry is acted on
+                checkManifestAlgorithm(manifest_reader)
+            return entries
+        if self.codec:
+            async for current in self.recieveFrames(connection):
+                entries = feed(current)
+                if entries:
+                    yield entries
+            if not manifest_reader.done:
+                raise ConnectionResetError("Compressed manifest ended early")
+        while not manifest_reader.done:
+            current = await connection.read(MANIFEST_CHUNK)
+            if not current:
+                raise ConnectionResetError("Connection closed in the middle of a manifest")
+            entries = feed(current)
+            if entries:
+                yield entries
+
+    async def streamDifferences(self, opcode, structure, root): # opcode is \x03 for Rimworld files, \x04 for config files. Yields (entry, node) pairs while the host is still comparing
+        connection = await self.request(opcode, self.codec)
+        try:
+            await self.sendManifestEntries(connection, structureEntries(structure), structure.digest)
+            tree = ManifestTree(root)
+            async for entries in self.recieveManifestChunks(connection):
+                yield tree.add(entries)
+        finally:
+            connection.close()
+
+    async def hostStructure(self, area, root): # The host's whole tree for an area, built under root without touching the disk
+        connection = await self.request(b"\x0b" + bytes([area]), self.codec)
+        try:
+            manifest_reader = ManifestReader()
+            tree = ManifestTree(root)
+            async for entries in self.recieveManifestChunks(connection, manifest_reader):
+                tree.add(entries)
+            root.digest = manifest_reader.root_digest
+            return root
+        finally:
+            connection.close()
+
+    async def differences(self, opcode, structure, root): # The whole comparison at once, grouped like compareStructures
+        differences = {
+            "delete" : [],
+            "modify" : [],
+            "add" : [],
+        }
+        async for pairs in self.streamDifferences(opcode, structure, root):
+            for entry, node in pairs:
+                differences[entry.section].append(node)
+        return differences
+
+    @staticmethod
+    async def recieveInto(connection, file, length, hasher, buffer): # Copies length bytes from the connection to file through one reused buffer
+        view = memoryview(buffer)
+        remaining = length
+        while remaining:
+            current = await connection.recvInto(view[:min(len(view), remaining)])
+            if not current:
+                raise ConnectionResetError("Connection closed with {} bytes left".format(remaining))
+            chunk = view[:current]
+            hasher.update(chunk)
+            file.write(chunk)
+            remaining -= current
+
+    async def recieveFramesInto(self, connection, file, length, hasher):
+        bytes_got = 0
+        async for current in self.recieveFrames(connection):
+            bytes_got += len(current)
+            if bytes_got > length:
+                raise ConnectionResetError("Compressed file is larger than announced")
+            hasher.update(current)
+            file.write(current)
+        if bytes_got != length:
+            raise ConnectionResetError("Compressed file ended after {} of {} bytes".format(bytes_got, length))
+
+    async def recieveVerifiedFile(self, connection, fileObj, file_size, buffer, compressed=False, offset=0):
+        # Written to a temporary file and hashed on the way in, only renamed over the real file if it matches the manifest.
+        # With a journal, large parts are kept when the transfer breaks off so the next run can continue from offset
+        part_name = fileObj.path() + PART_SUFFIX
+        hasher = newHash()
+        resumable = self.journal is not None and file_size >= RESUME_MIN_SIZE and fileObj.hash
+        if resumable:
+            self.journal.begin(part_name, fileObj.hash, file_size)
+        try:
+            with Server.clientOpenPart(part_name, hasher, offset) as file:
+                if compressed:
+                    await self.recieveFramesInto(connection, file, file_size - offset, hasher)
+                else:
+                    await self.recieveInto(connection, file, file_size - offset, hasher, buffer)
+        except BaseException:
+            if not resumable and os.path.exists(part_name):
+                os.remove(part_name)
+            raise
+        verified = Server.clientFinishPart(fileObj, part_name, hasher)
+        if resumable:
+            self.journal.finish(part_name)
+        return verified
+
+    async def recieveFiles(self, fileObjs, area=AREA_GAME, progress=None): # Asks for every file at once, the host answers with all of them back to back
+        connection = await self.request(b"\x05" + bytes([area]), self.codec)
+        try:
+            await self.sendManifestEntries(connection, (manifestEntry(x, "add") for x in fileObjs))
+            buffer = bytearray(RECEIVE_BUFFER)
+            for fileObj in fileObjs:
+                t0 = time.perf_counter()
+                status, file_size = FILE_HEADER.unpack(await connection.readExactly(FILE_HEADER.size))
+                if status != FILE_SENT:
+                    print("The host could not send {}".format(fileObj.relativePath()))
+                    verified = False
+                else:
+                    encoding = (await connection.readExactly(1))[0] if self.codec else ENCODING_RAW
+                    verified = await self.recieveVerifiedFile(connection, fileObj, file_size, buffer, encoding == ENCODING_FRAMES)
+                    CLIENT_METRICS.observe("file_recieve_seconds", time.perf_counter() - t0)
+                    CLIENT_METRICS.count("bytes_recieved", file_size)
+                    CLIENT_METRICS.count("files_recieved")
+                if progress:
+                    progress(fileObj, file_size, verified)
+        finally:
+            connection.close()
+
+    async def recieveRanges(self, ranges, area=AREA_GAME, progress=None): # Finishes interrupted downloads, ranges holds (fileObj, bytes already on disk)
+        connection = await self.request(b"\x09" + bytes([area]))
+        try:
+            requests = []
+            for fileObj, offset in ranges:
+                path = portablePath(fileObj).encode("utf-8", "surrogateescape")
+                requests.append(DELTA_PATH.pack(len(path)) + path + RANGE_OFFSET.pack(offset))
+            await connection.send(b"".join(requests) + DELTA_PATH.pack(0))
+            buffer = bytearray(RECEIVE_BUFFER)
+            for fileObj, offset in ranges:
+                status, file_size, start = RANGE_HEADER.unpack(await connection.readExactly(RANGE_HEADER.size))
+                if status != FILE_SENT:
+                    print("The host could not send {}".format(fileObj.relativePath()))
+                    verified = False
+                else:
+                    verified = await self.recieveVerifiedFile(connection, fileObj, file_size, buffer, offset=start)
+                    CLIENT_METRICS.count("bytes_recieved", file_size - start)
+                    CLIENT_METRICS.count("files_resumed")
+                if progress:
+                    progress(fileObj, file_size, verified, file_size - start, resumed=True)
+        finally:
+            connection.close()
 
 def automaticSync(packets):
     print()
@@ -131,171 +896,742 @@ def client():
     else:
         sync_config = False
 
-    print("Analyzing rimworld...")
-    my_structure = generateStructure(".")
-    my_structure_pickled = pickle.dumps(my_structure)
     print("Connecting to host...")
-    s = socket.socket()
+    offered = [] if "--nocompression" in sys.argv else list(COMPRESSION_CODECS)
     try:
-        s.connect((IP_ADDRESS, PORT))
-    except:
+        reply, = runConcurrently(AsyncClient().hello({"compression" : offered, "hash" : list(HASH_ALGORITHMS)})) # Before scanning, the host decides how files are hashed
+    except OSError:
         print("No one is hosting at IP: {}:{}. Please check if the IP is valid and if there are firewalls up".format(IP_ADDRESS, PORT))
         return hangForever()
-    print("Syncing files...")
-    s.send(b"\x00") # Request comparison of Rimworld files
-    Server.clientSendPickle(s, my_structure_pickled) # Send my Rimworld structure
-    packets = Server.clientRecievePickle(s) # Recieve differences
-    s.close()
-    s = socket.socket()
-    s.connect((IP_ADDRESS, PORT))
+    if "error" in reply:
+        print(reply["error"])
+        return hangForever()
+    codec = reply.get("compression", None)
+    algorithm = reply.get("hash", "sha256")
+    if algorithm not in HASH_ALGORITHMS:
+        print("The host hashes files with {}, which this copy of rimlink does not support".format(algorithm))
+        return hangForever()
+    setHashAlgorithm(algorithm)
+
+    async_client = AsyncClient(codec)
+    areas = [(AREA_GAME, b"\x03", ".", HashStructure, {})] # Rimworld files
     if sync_config:
-        my_config = generateStructure(AppDataStructure.getRimworldConfigArea(), app_data=AppDataStructure.getRimworldConfigArea())
-        my_config_pickled = pickle.dumps(my_config)
-        s.send(b"\02")
-        Server.clientSendPickle(s, my_config_pickled)
-        config_packets = Server.clientRecievePickle(s)
-        packets['delete'].extend(config_packets['delete'])
-        packets['add'].extend(config_packets['add'])
-        packets['modify'].extend(config_packets['modify'])
-
-    if automaticSync(packets):
-        clientSyncFiles(packets['delete'], packets['add'], packets['modify'])
+        config_area = AppDataStructure.getRimworldConfigArea()
+        areas.append((AREA_CONFIG, b"\x04", config_area, AppDataStructure, {"app_data" : config_area}))
+    lazy = "--fullscan" not in sys.argv
+    if lazy: # The host's file list first, so only files that have the host's size and are not in the hash cache get hashed
+        with CLIENT_METRICS.timer("manifest_seconds"):
+            host_structures = runConcurrently(*[async_client.hostStructure(area, kind(location, isfile=False, defer_hash=True)) for area, _, location, kind, _ in areas])
+
+    print("Analyzing rimworld...")
+    hash_cache = HashCache().load()
+    hashing_engine = hashingEngine()
+    my_structures = []
+    for i, (area, _, location, kind, options) in enumerate(areas):
+        if lazy:
+            options = dict(options, expected_sizes=fileSizes(host_structures[i]))
+        with CLIENT_METRICS.timer("scan_seconds"):
+            my_structures.append(generateStructure(location, hash_cache=hash_cache, hashing_engine=hashing_engine, **options))
+    reportHashCache(hash_cache)
+    if lazy:
+        print("{} files differ in size from the host's and were not hashed".format(hashing_engine.files_settled))
+    CLIENT_METRICS.gauge("files_hashed", hashing_engine.files_hashed)
+    CLIENT_METRICS.gauge("bytes_hashed", hashing_engine.bytes_hashed)
+    CLIENT_METRICS.gauge("files_settled", hashing_engine.files_settled)
+    print("Syncing files{}...".format(" with {} compression".format(codec) if codec else ""))
+    comparisons = [(opcode, mine, kind(location, isfile=False, defer_hash=True)) for (_, opcode, location, kind, _), mine in zip(areas, my_structures)]
+    if "--confirm" in sys.argv: # The whole comparison first, listed for the player to approve before anything changes
+        with CLIENT_METRICS.timer("comparison_seconds"):
+            if lazy:
+                differences = [compareStructures(host, mine) for host, mine in zip(host_structures, my_structures)]
+            else:
+                differences = runConcurrently(*[async_client.differences(*x) for x in comparisons])
+        packets = differences[0]
+        for config_packets in differences[1:]:
+            packets['delete'].extend(config_packets['delete'])
+            packets['add'].extend(config_packets['add'])
+            packets['modify'].extend(config_packets['modify'])
+        if automaticSync(packets):
+            with CLIENT_METRICS.timer("sync_seconds"):
+                clientSyncFiles(packets['delete'], packets['add'], packets['modify'], hash_cache=hash_cache, codec=codec, local_structures=my_structures, journal=TransferJournal().load())
+    elif lazy:
+        with CLIENT_METRICS.timer("sync_seconds"):
+            local_differences = [lazyDifferences(host, mine) for host, mine in zip(host_structures, my_structures)]
+            clientStreamSync([], local_differences=local_differences, local_structures=my_structures, hash_cache=hash_cache, codec=codec, journal=TransferJournal().load())
+    else:
+        with CLIENT_METRICS.timer("sync_seconds"):
+            clientStreamSync(comparisons, hash_cache=hash_cache, codec=codec, journal=TransferJournal().load())
+    hash_cache.save()
+    if codec:
+        print("Compression: {}".format(COMPRESSION_STATS))
+    reportMetrics(CLIENT_METRICS)
+    if "--hoststats" in sys.argv:
+        print(json.dumps(runConcurrently(async_client.stats())[0], indent=2))
     print("Sync complete")
     hangForever()
 
-class Server:
+def peerName(w): # Connections from the same address count as one client for fairness and accounting
+    peer = w.get_extra_info("peername")
+    return peer[0] if peer else "unknown"
+
+class TransferScheduler: # Admission and upload bandwidth for the host, shared round robin between clients rather than between connections
+    def __init__(self, max_transfers=0, rate=0, client_rate=0, metrics=None):
+        self.max_transfers = max_transfers # 0 means unlimited, as do the rates
+        self.bucket = TokenBucket(rate) if rate else None
+        self.client_rate = client_rate
+        self.client_buckets = {}
+        self.metrics = metrics or Metrics()
+        self.active = 0
+        self.admissions = OrderedDict() # peer -> (future, 0) waiting for a transfer slot
+        self.sends = OrderedDict() # peer -> (future, size) waiting for bandwidth
+        self.dispatcher = None
+
+    @property
+    def limited(self):
+        return self.bucket is not None or self.client_rate > 0
+
     @staticmethod
-    def clientSendPickle(socket, pickled_data):
-        assert isinstance(pickled_data, bytes)
-        pickle_length = len(pickled_data)
-        pickle_length_as_bytes = pickle_length.to_bytes(8, byteorder="big")
-        socket.send(pickle_length_as_bytes)
-        time.sleep(.1)
-        socket.send(pickled_data)
-        print("Data sent")
+    def nextInLine(queues): # The peer at the front is served once and goes to the back of the line
+        while queues:
+            peer, queue = next(iter(queues.items()))
+            item = queue.popleft()
+            if queue:
+                queues.move_to_end(peer)
+            else:
+                del queues[peer]
+            if not item[0].done(): # Skips waiters whose connection went away
+                return item
+        return None
+
+    def updateGauges(self):
+        self.metrics.gauge("transfers_active", self.active)
+        self.metrics.gauge("transfers_queued", sum(len(x) for x in self.admissions.values()))
+        self.metrics.gauge("sends_queued", sum(len(x) for x in self.sends.values()))
+
+    async def admit(self, peer):
+        if not self.max_transfers or (self.active < self.max_transfers and not self.admissions):
+            self.active += 1
+            self.updateGauges()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.admissions.setdefault(peer, deque()).append((future, 0))
+        self.updateGauges()
+        t0 = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled(): # Granted just as the connection went away, pass the slot on
+                self.release()
+            raise
+        finally:
+            self.metrics.observe("admission_wait_seconds", time.perf_counter() - t0)
+            self.updateGauges()
+
+    def release(self):
+        self.active -= 1
+        while not self.max_transfers or self.active < self.max_transfers:
+            item = self.nextInLine(self.admissions)
+            if item is None:
+                break
+            self.active += 1
+            item[0].set_result(None)
+        self.updateGauges()
+
+    async def throttle(self, peer, size): # Waits until size more bytes may be sent to peer
+        if not self.limited:
+            return
+        t0 = time.perf_counter()
+        if self.client_rate:
+            bucket = self.client_buckets.get(peer, None)
+            if bucket is None:
+                bucket = self.client_buckets[peer] = TokenBucket(self.client_rate)
+            delay = bucket.reserve(size)
+            if delay:
+                await asyncio.sleep(delay)
+        if self.bucket is not None:
+            future = asyncio.get_running_loop().create_future()
+            self.sends.setdefault(peer, deque()).append((future, size))
+            self.updateGauges()
+            if self.dispatcher is None:
+                self.dispatcher = asyncio.ensure_future(self.dispatch())
+            await future
+        self.metrics.observe("throttle_wait_seconds", time.perf_counter() - t0)
+
+    async def dispatch(self): # Hands out the global bandwidth one send at a time, round robin between clients
+        try:
+            while True:
+                item = self.nextInLine(self.sends)
+                if item is None:
+                    return
+                future, size = item
+                delay = self.bucket.reserve(size)
+                if delay:
+                    await asyncio.sleep(delay)
+                if not future.done():
+                    future.set_result(None)
+                self.updateGauges()
+        finally:
+            self.dispatcher = None
+
+class Server:
+    def __init__(self):
+        self.structure_indexes = {}
+        self.compression_stats = CompressionStats()
+        self.diff_cache = DiffCache(int(commandLineValue("--diffcachemb", 64)) * 1024*1024)
+        self.in_flight = {} # diff cache key -> (base structure, future of the result) for results still being worked out
+        self.hash_cache = None
+        self.hashing_engine = None
+        self.watchers = []
+        self.rescan_lock = threading.Lock()
+        self.metrics = Metrics()
+        self.executor = comparisonExecutor()
+        self.transfers = TransferScheduler(int(commandLineValue("--maxtransfers", 32)), float(commandLineValue("--uploadlimit", 0)) * 1e6, float(commandLineValue("--clientlimit", 0)) * 1e6, self.metrics)
 
     @staticmethod
-    def clientRecievePickle(socket):
-        data_length_in_bytes = socket.recv(8)
-        data_length = int.from_bytes(data_length_in_bytes, byteorder="big")
-        BYTES_PER_TICK = 1024
+    def clientRecieveExactly(socket, length):
+        data = bytearray(length)
+        view = memoryview(data)
         bytes_got = 0
-        chunks = []
-        while bytes_got < data_length:
-            bytes_to_get = min(BYTES_PER_TICK, data_length - bytes_got)
-            current = socket.recv(bytes_to_get)
-            chunks.append(current)
-            bytes_got += len(current)
-        pickled_recieve = b"".join(chunks)
-        unpickled_data = pickle.loads(pickled_recieve)
-        return unpickled_data
+        while bytes_got < length:
+            current = socket.recv_into(view[bytes_got:])
+            if not current:
+                raise ConnectionResetError("Connection closed after {} of {} bytes".format(bytes_got, length))
+            bytes_got += current
+        return data
 
     @staticmethod
-    def clientSendString(socket, givenString):
-        assert isinstance(givenString, str)
-        encoded_string = givenString.encode()
-        string_length = len(encoded_string)
-        string_length_in_bytes = string_length.to_bytes(8, byteorder="big")
-        socket.send(string_length_in_bytes)
-        time.sleep(.1)
-        socket.send(encoded_string)
+    def clientRecieveInto(socket, file, length, hasher=None, buffer=None): # Copies length bytes from the socket to file through one reused buffer
+        view = memoryview(buffer or bytearray(RECEIVE_BUFFER))
+        remaining = length
+        while remaining:
+            current = socket.recv_into(view, min(len(view), remaining))
+            if not current:
+                raise ConnectionResetError("Connection closed with {} bytes left".format(remaining))
+            chunk = view[:current]
+            if hasher:
+                hasher.update(chunk)
+            file.write(chunk)
+            remaining -= current
 
     @staticmethod
-    def clientRecieveFile(socket, fileObj):
-        assert isinstance(fileObj, FileFolder)
-        socket.send(b"\x01")
-        pickled_obj = pickle.dumps(fileObj)
-        Server.clientSendPickle(socket, pickled_obj)
-        file_size_bytes = socket.recv(8)
-        file_size = int.from_bytes(file_size_bytes, byteorder="big")
-        bytes_recieved = 0
-        file = open(fileObj.path(), "wb")
-        while bytes_recieved < file_size:
-            current = socket.recv(1024)
-            bytes_recieved += len(current)
-            file.write(current)
-        file.close()
+    def clientOpenPart(part_name, hasher, offset=0): # Opened for writing at offset, the part is hashed again rather than trusted, a bad tail simply fails verification
+        file = open(part_name, "r+b" if offset else "wb")
+        try:
+            if offset:
+                for chunk in iter(lambda: file.read(min(RECEIVE_BUFFER, offset - file.tell())), b""):
+                    hasher.update(chunk)
+                if file.tell() != offset:
+                    raise ConnectionResetError("{} is shorter than the journal says".format(part_name))
+                file.truncate()
+        except BaseException:
+            file.close()
+            raise
+        return file
 
-    async def sendPickle(self, pickled_data, w):
-        assert isinstance(pickled_data, bytes)
-        pickle_length = len(pickled_data)
-        pickle_length_as_bytes = pickle_length.to_bytes(8, byteorder="big")
-        w.write(pickle_length_as_bytes)
+    @staticmethod
+    def clientFinishPart(fileObj, part_name, hasher):
+        expected = getattr(fileObj, "hash", None)
+        if expected and len(expected) == hasher.digest_size * 2 and hasher.hexdigest() != expected:
+            os.remove(part_name)
+            return False
+        os.replace(part_name, fileObj.path())
+        return True
+
+    @staticmethod
+    def clientRecieveDelta(socket, fileObj, block_size, buffer=None): # Rebuilds fileObj from its current copy and the host's instructions
+        part_name = fileObj.path() + PART_SUFFIX
+        hasher = newHash()
+        bytes_transferred = 0
+        try:
+            with open(fileObj.path(), "rb") as source, open(part_name, "wb") as destination:
+                while True:
+                    kind = Server.clientRecieveExactly(socket, 1)
+                    if kind == b"E":
+                        break
+                    value = DELTA_VALUE.unpack(Server.clientRecieveExactly(socket, DELTA_VALUE.size))[0]
+                    if kind == b"C":
+                        applyDelta(source, [("copy", value)], block_size, destination, hasher)
+                    elif kind == b"D":
+                        Server.clientRecieveInto(socket, destination, value, hasher, buffer)
+                        bytes_transferred += value
+                    else:
+                        raise ConnectionResetError("Invalid delta instruction {!r}".format(kind))
+        except BaseException:
+            if os.path.exists(part_name):
+                os.remove(part_name)
+            raise
+        return Server.clientFinishPart(fileObj, part_name, hasher), bytes_transferred
+
+    @staticmethod
+    def clientRecieveDeltas(socket, fileObjs, area=AREA_GAME, progress=None): # One request per file on the same connection, each answered before the next is sent
+        socket.send(b"\x06" + bytes([area]))
+        buffer = bytearray(RECEIVE_BUFFER)
+        for fileObj in fileObjs:
+            source_size = os.path.getsize(fileObj.path())
+            block_size = deltaBlockSize(source_size)
+            signatures = blockSignatures(fileObj.path(), block_size)
+            path = portablePath(fileObj).encode("utf-8", "surrogateescape")
+            socket.sendall(DELTA_PATH.pack(len(path)) + path + DELTA_SOURCE.pack(source_size, block_size, len(signatures)) + b"".join(DELTA_SIGNATURE.pack(*x) for x in signatures))
+            status, file_size = FILE_HEADER.unpack(Server.clientRecieveExactly(socket, FILE_HEADER.size))
+            if status != FILE_SENT:
+                verified, bytes_transferred = False, 0
+            else:
+                verified, bytes_transferred = Server.clientRecieveDelta(socket, fileObj, block_size, buffer)
+            if progress:
+                progress(fileObj, file_size, verified, bytes_transferred)
+        socket.sendall(DELTA_PATH.pack(0))
+
+    async def offload(self, function, *args, executor=True): # Runs CPU heavy work off the event loop, on the comparison pool or else the loop's own threads
+        if not executor:
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+        t0 = time.perf_counter()
+        self.metrics.adjust("comparisons_running", 1)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.metrics.adjust("comparisons_running", -1)
+            self.metrics.observe("comparison_seconds/{}".format(function.__name__), time.perf_counter() - t0)
+
+    async def recieveFrames(self, r, codec):
+        decompressor = self.compression_stats.decompressor(codec)
+        while True:
+            length = FRAME.unpack(await r.readexactly(FRAME.size))[0]
+            if length == 0:
+                return
+            if length > MAX_FRAME:
+                raise ManifestError("Oversized frame of {} bytes".format(length))
+            pieces = decompressor.decompress(await r.readexactly(length))
+            current = await self.offload(nextChunk, pieces, executor=False) # A piece at a time, so a small frame still cannot balloon in memory
+            while current is not None:
+                yield current
+                current = await self.offload(nextChunk, pieces, executor=False)
+
+    async def sendFrames(self, chunks, w, codec):
+        compressor = self.compression_stats.compressor(codec)
+        peer = peerName(w)
+        async for chunk in asyncChunks(chunks):
+            data = await self.offload(compressor.compress, chunk, executor=False)
+            for i in range(0, len(data), MAX_FRAME):
+                await self.transfers.throttle(peer, len(data[i:i + MAX_FRAME]))
+                w.write(FRAME.pack(len(data[i:i + MAX_FRAME])))
+                w.write(data[i:i + MAX_FRAME])
+                await w.drain()
+        data = await self.offload(compressor.flush, executor=False)
+        for i in range(0, len(data), MAX_FRAME):
+            await self.transfers.throttle(peer, len(data[i:i + MAX_FRAME]))
+            w.write(FRAME.pack(len(data[i:i + MAX_FRAME])))
+            w.write(data[i:i + MAX_FRAME])
+        w.write(FRAME.pack(0))
         await w.drain()
-        w.write(pickled_data)
+
+    async def recieveManifestEntries(self, r, codec=None, hasher=None): # hasher sees the uncompressed manifest bytes
+        manifest_reader = ManifestReader()
+        entries = []
+        def feed(current): # The reader keeps state between chunks, so it is decoded on the loop's threads rather than the comparison pool
+            if hasher:
+                hasher.update(current)
+            return manifest_reader.feed(current)
+        if codec:
+            async for current in self.recieveFrames(r, codec):
+                entries.extend(await self.offload(feed, current, executor=False))
+            if not manifest_reader.done:
+                raise ManifestError("Compressed manifest ended early")
+        while not manifest_reader.done:
+            current = await r.read(MANIFEST_CHUNK)
+            if not current:
+                raise ConnectionResetError("Connection closed in the middle of a manifest")
+            entries.extend(await self.offload(feed, current, executor=False))
+        checkManifestAlgorithm(manifest_reader)
+        return entries, manifest_reader.root_digest
+
+    async def recieveManifest(self, r, root, codec=None):
+        entries, root_digest = await self.recieveManifestEntries(r, codec)
+        return structureFromManifest(entries, root, root_digest)
+
+    def structureForArea(self, area):
+        if area == AREA_CONFIG:
+            return self.base_app_data_structure
+        return self.base_structure
+
+    def rescanArea(self, area, changed): # Called from a watcher thread once a burst of changes has settled
+        with self.rescan_lock:
+            started = time.time()
+            old_structure = self.structureForArea(area)
+            structure = rescanStructure(old_structure, changed, hash_cache=self.hash_cache, hashing_engine=self.hashing_engine)
+            # A single assignment, comparisons hold on to whichever tree they started with
+            if area == AREA_CONFIG:
+                self.base_app_data_structure = structure
+            else:
+                self.base_structure = structure
+            self.diff_cache.invalidate(old_structure)
+            if self.hash_cache is not None:
+                self.hash_cache.save()
+            self.metrics.observe("rescan_seconds", time.time() - started)
+            print("Rescanned {} changed folder(s) in {:.2f}s".format(len(changed), time.time() - started))
+
+    def watchAreas(self):
+        backend = watchBackend(commandLineValue("--watch", "auto"))
+        if backend == "off":
+            return
+        for area, location in ((AREA_GAME, "."), (AREA_CONFIG, AppDataStructure.getRimworldConfigArea())):
+            watcher = TreeWatcher(location, lambda changed, area=area: self.rescanArea(area, changed), backend)
+            watcher.start()
+            self.watchers.append(watcher)
+
+    async def indexForArea(self, area): # Built on first use and rebuilt whenever the structure is replaced
+        structure = self.structureForArea(area)
+        cached = self.structure_indexes.get(area, None)
+        if cached is None or cached[0] is not structure:
+            cached = (structure, await self.offload(structureIndex, structure, executor=False))
+            self.structure_indexes[area] = cached
+        return cached[1]
+
+    async def sendFileContents(self, file_obj, file_size, w, offset=0):
+        # loop.sendfile goes through os.sendfile/TransmitFile when the transport allows it, otherwise it falls back
+        # to reading bounded chunks in an executor and waiting on flow control, so memory use never grows with file size
+        # With a bandwidth limit the file goes out FILE_CHUNK at a time, each chunk waiting its turn in the transfer scheduler
         await w.drain()
-        print("Data sent")
+        peer = peerName(w)
+        step = FILE_CHUNK if self.transfers.limited else file_size - offset
+        while offset < file_size:
+            count = min(step, file_size - offset)
+            await self.transfers.throttle(peer, count)
+            bytes_sent = await asyncio.get_running_loop().sendfile(w.transport, file_obj, offset, count)
+            if bytes_sent != count:
+                raise ConnectionResetError("{} shrank while being sent".format(file_obj.name))
+            offset += count
 
-    async def recievePickle(self, r):
-        pickled_recieve = await self.recieveData(r)
-        unpickled_data = pickle.loads(pickled_recieve)
-        return unpickled_data
+    async def sendCompressedContents(self, file_obj, file_size, w, codec): # Read and compressed on the loop's threads, other clients' transfers carry on meanwhile
+        bytes_read = 0
+        async def chunks():
+            nonlocal bytes_read
+            while bytes_read < file_size:
+                current = await self.offload(file_obj.read, min(FILE_CHUNK, file_size - bytes_read), executor=False)
+                if not current:
+                    raise ConnectionResetError("{} shrank while being sent".format(file_obj.name))
+                bytes_read += len(current)
+                yield current
+        await self.sendFrames(chunks(), w, codec)
 
-    async def comparison(self, r, w):
-        assert isinstance(r, asyncio.StreamReader)
-        assert isinstance(w, asyncio.StreamWriter)
-        other_structure = await self.recievePickle(r)
-        differences = compareStructures(self.base_structure, other_structure)
-        pickled_differences = pickle.dumps(differences)
-        await self.sendPickle(pickled_differences, w)
-        print("Seeking rimworld differences for {}".format(w.get_extra_info("peername")))
-
-    async def recieveData(self, r):
-        data_length_in_bytes = await r.read(8)
-        data_length = int.from_bytes(data_length_in_bytes, byteorder="big")
-        BYTES_PER_TICK = 1024
-        bytes_got = 0
-        chunks = []
-        while bytes_got < data_length:
-            bytes_to_get = min(BYTES_PER_TICK, data_length - bytes_got)
-            current = await r.read(bytes_to_get)
-            chunks.append(current)
-            bytes_got += len(current)
-        return b"".join(chunks)
-
-    async def sendFile(self, r, w):
-        # file_name = await self.recieveData(r)
-        file_obj = await self.recievePickle(r)
-        assert isinstance(file_obj, FileFolder)
-        file_name = file_obj.path()
-        file_obj = open(file_name, "rb")
-        file_bytes = file_obj.read()
-        file_size = os.stat(file_name).st_size
-        file_size_in_bytes = file_size.to_bytes(8, byteorder="big")
-        w.write(file_size_in_bytes)
+    async def streamFile(self, file_name, w, codec=None): # Writes the header and contents of one file of a batched response
+        try:
+            file_obj = open(file_name, "rb")
+        except OSError:
+            w.write(FILE_HEADER.pack(FILE_MISSING, 0))
+            return 0
+        with file_obj:
+            file_size = os.fstat(file_obj.fileno()).st_size
+            w.write(FILE_HEADER.pack(FILE_SENT, file_size))
+            if codec and shouldCompress(file_name, file_size):
+                w.write(bytes([ENCODING_FRAMES]))
+                await self.sendCompressedContents(file_obj, file_size, w, codec)
+            else:
+                if codec:
+                    w.write(bytes([ENCODING_RAW]))
+                await self.sendFileContents(file_obj, file_size, w)
+        return file_size
+
+    async def sendDeltas(self, r, w):
+        area = (await r.readexactly(1))[0]
+        index = await self.indexForArea(area)
+        files_sent = 0
+        bytes_sent = 0
+        while True:
+            path_length = DELTA_PATH.unpack(await r.readexactly(DELTA_PATH.size))[0]
+            if path_length == 0:
+                break
+            path = (await r.readexactly(path_length)).decode("utf-8", "surrogateescape")
+            source_size, block_size, count = DELTA_SOURCE.unpack(await r.readexactly(DELTA_SOURCE.size))
+            if not 0 < block_size <= DELTA_MAX_BLOCK or count > DELTA_MAX_SIGNATURES or count != -(-source_size // block_size):
+                raise ManifestError("Invalid delta request for {!r}".format(path))
+            signatures = list(DELTA_SIGNATURE.iter_unpack(await r.readexactly(count * DELTA_SIGNATURE.size)))
+            structure = index.get(path, None) if validManifestPath(path) else None
+            try:
+                file_size = os.path.getsize(structure.path()) if structure is not None and structure.file else None
+            except OSError:
+                file_size = None
+            if file_size is None:
+                w.write(FILE_HEADER.pack(FILE_MISSING, 0))
+                continue
+            w.write(FILE_HEADER.pack(FILE_SENT, file_size))
+            instructions = computeDelta(structure.path(), block_size, signatures, source_size)
+            while True: # The rolling checksum is worked out a batch at a time on the loop's threads
+                batch = await self.offload(deltaBatch, instructions, executor=False)
+                if not batch:
+                    break
+                for kind, value in batch:
+                    if kind == "copy":
+                        w.write(b"C" + DELTA_VALUE.pack(value))
+                    else:
+                        await self.transfers.throttle(peerName(w), len(value))
+                        w.write(b"D" + DELTA_VALUE.pack(len(value)))
+                        w.write(value)
+                        bytes_sent += len(value)
+                await w.drain()
+            w.write(b"E")
+            files_sent += 1
         await w.drain()
-        w.write(file_bytes)
+        self.countSent(w, files_sent, bytes_sent)
+        print("Sent deltas of {} files ({} bytes) to {}".format(files_sent, bytes_sent, w.get_extra_info("peername")))
+
+    async def sendRanges(self, r, w): # The rest of each file from the offset the client already has, for resuming interrupted downloads
+        area = (await r.readexactly(1))[0]
+        index = await self.indexForArea(area)
+        files_sent = 0
+        bytes_sent = 0
+        while True:
+            path_length = DELTA_PATH.unpack(await r.readexactly(DELTA_PATH.size))[0]
+            if path_length == 0:
+                break
+            path = (await r.readexactly(path_length)).decode("utf-8", "surrogateescape")
+            offset = RANGE_OFFSET.unpack(await r.readexactly(RANGE_OFFSET.size))[0]
+            structure = index.get(path, None) if validManifestPath(path) else None
+            try:
+                file_obj = open(structure.path(), "rb") if structure is not None and structure.file else None
+            except OSError:
+                file_obj = None
+            if file_obj is None:
+                w.write(RANGE_HEADER.pack(FILE_MISSING, 0, 0))
+                continue
+            with file_obj:
+                file_size = os.fstat(file_obj.fileno()).st_size
+                start = offset if offset <= file_size else 0 # The file changed under the client, it starts over
+                w.write(RANGE_HEADER.pack(FILE_SENT, file_size, start))
+                await self.sendFileContents(file_obj, file_size, w, start)
+            files_sent += 1
+            bytes_sent += file_size - start
         await w.drain()
-        file_obj.close()
-        print("Sent {} to {}".format(file_name, w.get_extra_info("peername")))
-            
-    async def configComparison(self, r, w):
-        other_structure = await self.recievePickle(r)
-        differences = compareStructures(self.base_app_data_structure, other_structure)
-        pickled_differences = pickle.dumps(differences)
-        await self.sendPickle(pickled_differences, w)
-        print("Seeking config differences for {}".format(w.get_extra_info("peername")))
+        self.countSent(w, files_sent, bytes_sent)
+        print("Resumed {} files ({} bytes) for {}".format(files_sent, bytes_sent, w.get_extra_info("peername")))
+
+    def countSent(self, w, files_sent, bytes_sent):
+        self.metrics.count("files_sent", files_sent)
+        self.metrics.count("bytes_sent", bytes_sent)
+        self.metrics.count("bytes_sent/{}".format(peerName(w)), bytes_sent)
+
+    def stats(self): # Everything the stats opcode and the periodic dumps report
+        snapshot = self.metrics.snapshot()
+        if self.hashing_engine is not None:
+            snapshot["gauges"]["files_hashed"] = self.hashing_engine.files_hashed
+            snapshot["gauges"]["bytes_hashed"] = self.hashing_engine.bytes_hashed
+        snapshot["diff_cache"] = {"hits" : self.diff_cache.hits, "misses" : self.diff_cache.misses, "evictions" : self.diff_cache.evictions, "bytes" : self.diff_cache.total_bytes}
+        snapshot["compression"] = {"raw_bytes" : self.compression_stats.raw_bytes, "wire_bytes" : self.compression_stats.wire_bytes, "seconds" : self.compression_stats.seconds}
+        return snapshot
+
+    async def sendStats(self, r, w):
+        reply = json.dumps(self.stats()).encode()
+        w.write(FRAME.pack(len(reply)) + reply)
+        await w.drain()
+
+    async def dumpMetrics(self, location, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.metrics.dump(location, self.stats())
+            except OSError as e:
+                print("Could not write metrics to {}: {}".format(location, e))
+
+    async def sendFiles(self, r, w, codec=None):
+        area = (await r.readexactly(1))[0]
+        index = await self.indexForArea(area)
+        entries, _ = await self.recieveManifestEntries(r, codec)
+        bytes_sent = 0
+        for entry in entries:
+            structure = index.get(entry.path, None)
+            if structure is None or not structure.file: # Only files the host is sharing can be asked for
+                w.write(FILE_HEADER.pack(FILE_MISSING, 0))
+                continue
+            t0 = time.perf_counter()
+            bytes_sent += await self.streamFile(structure.path(), w, codec)
+            self.metrics.observe("file_send_seconds", time.perf_counter() - t0)
+        await w.drain()
+        self.countSent(w, len(entries), bytes_sent)
+        print("Sent {} files ({} bytes) to {}".format(len(entries), bytes_sent, w.get_extra_info("peername")))
+        if codec:
+            print("Compression: {}".format(self.compression_stats))
+
+    async def sendManifest(self, entries, w, codec=None):
+        await self.sendEncodedManifest(encodeManifest(entries), w, codec)
+
+    async def sendEncodedManifest(self, chunks, w, codec=None):
+        if codec:
+            return await self.sendFrames(chunks, w, codec)
+        async for chunk in asyncChunks(chunks):
+            w.write(chunk)
+            await w.drain()
+
+    async def sharedResult(self, key, base): # Cached, or awaited from an identical request already working it out. None means this request has to
+        encoded = self.diff_cache.lookup(key, base)
+        running = self.in_flight.get(key, None)
+        if encoded is None and running is not None and running[0] is base:
+            encoded = await asyncio.shield(running[1])
+            if encoded is not None:
+                self.metrics.count("shared_results")
+        return encoded
+
+    def startResult(self, key, base):
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = (base, future)
+        return future
+
+    def finishResult(self, key, base, encoded): # Cached, and handed to every identical request waiting on it
+        self.diff_cache.store(key, base, encoded)
+        running = self.in_flight.get(key, None)
+        if running is not None and running[0] is base:
+            del self.in_flight[key]
+            if not running[1].done():
+                running[1].set_result(encoded)
+
+    def dropResult(self, key, future): # The request working it out went away, the ones waiting on it work it out themselves
+        if self.in_flight.get(key, (None, None))[1] is future:
+            del self.in_flight[key]
+        if not future.done():
+            future.set_result(None)
+
+    async def comparisonChunks(self, base, entries, root_digest, key): # Steps the comparison off the loop, each chunk goes out as soon as the next one is encoded
+        if not isinstance(self.executor, ThreadPoolExecutor): # A process pool cannot hand back a generator, its result goes out in one piece
+            encoded = await self.offload(manifestDifferences, base, entries, root_digest, rimlink.HASH_ALGORITHM)
+            self.finishResult(key, base, encoded)
+            yield encoded
+            return
+        chunks = manifestDifferenceChunks(base, entries, root_digest, rimlink.HASH_ALGORITHM)
+        produced = []
+        chunk = await self.offload(nextChunk, chunks)
+        while chunk is not None:
+            following = await self.offload(nextChunk, chunks)
+            produced.append(chunk)
+            if following is None: # Cached before the client has the last chunk, so a client asking straight after finds it
+                self.finishResult(key, base, b"".join(produced))
+            yield chunk
+            chunk = following
+
+    async def streamManifestComparison(self, r, w, area, codec=None):
+        # Most players run identical installs, so the same manifest tends to arrive from everyone at once.
+        # The key is hashed from the bytes as received rather than the root digest the client claims
+        hasher = newHash()
+        entries, root_digest = await self.recieveManifestEntries(r, codec, hasher)
+        base = self.structureForArea(area)
+        key = (b"\x03", area, hasher.digest())
+        encoded = await self.sharedResult(key, base)
+        if encoded is not None:
+            return await self.sendEncodedManifest([encoded], w, codec)
+        future = self.startResult(key, base)
+        try:
+            await self.sendEncodedManifest(self.comparisonChunks(base, entries, root_digest, key), w, codec)
+        finally:
+            self.dropResult(key, future)
+
+    async def sendStructureManifest(self, r, w, codec=None): # The host's whole manifest for an area, so a client can settle most of its files by size before hashing
+        area = (await r.readexactly(1))[0]
+        base = self.structureForArea(area)
+        key = (b"\x0b", area)
+        encoded = await self.sharedResult(key, base) # Identical for every client until the next rescan replaces base
+        if encoded is None:
+            future = self.startResult(key, base)
+            try:
+                encoded = await self.offload(structureManifest, base, rimlink.HASH_ALGORITHM)
+                self.finishResult(key, base, encoded)
+            finally:
+                self.dropResult(key, future)
+        await self.sendEncodedManifest([encoded], w, codec)
+        print("Sent the file list to {}".format(w.get_extra_info("peername")))
+
+    async def manifestComparison(self, r, w, codec=None):
+        await self.streamManifestComparison(r, w, AREA_GAME, codec)
+        print("Seeking rimworld differences for {} (diff cache: {})".format(w.get_extra_info("peername"), self.diff_cache))
+
+    async def configManifestComparison(self, r, w, codec=None):
+        await self.streamManifestComparison(r, w, AREA_CONFIG, codec)
+        print("Seeking config differences for {} (diff cache: {})".format(w.get_extra_info("peername"), self.diff_cache))
+
+    async def hello(self, r, w):
+        length = FRAME.unpack(await r.readexactly(FRAME.size))[0]
+        if length > HELLO_LIMIT:
+            raise ManifestError("Oversized hello")
+        try:
+            capabilities = json.loads(await r.readexactly(length))
+            offered = [x for x in capabilities.get("compression", []) if isinstance(x, str)]
+            hashes = [x for x in capabilities.get("hash", ["sha256"]) if isinstance(x, str)] # Clients from before the negotiation only had sha256
+        except (ValueError, AttributeError, TypeError):
+            raise ManifestError("Malformed hello")
+        # The host's structures are already hashed, so its algorithm is not up for negotiation. A client without it is turned away here
+        reply = {"compression" : chooseCodec(offered), "codecs" : list(COMPRESSION_CODECS), "hash" : rimlink.HASH_ALGORITHM}
+        if rimlink.HASH_ALGORITHM not in hashes:
+            reply["error"] = "The host hashes files with {}, which this copy of rimlink does not support. The host can start with --hashalgorithm sha256".format(rimlink.HASH_ALGORITHM)
+            self.metrics.count("rejected_requests")
+        reply = json.dumps(reply).encode()
+        w.write(FRAME.pack(len(reply)) + reply)
+        await w.drain()
+
     async def _handle_client(self, r, w):
         assert isinstance(r, asyncio.StreamReader)
         assert isinstance(w, asyncio.StreamWriter)
         # print("Connection recieved from {}".format(w.get_extra_info("peername")))
+        w.transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
         BYTE_MAP = {
-            b"\x00" : self.comparison,
-            b"\x01" : self.sendFile,
-            b"\x02" : self.configComparison,
+            b"\x03" : self.manifestComparison,
+            b"\x04" : self.configManifestComparison,
+            b"\x05" : self.sendFiles,
+            b"\x06" : self.sendDeltas,
+            b"\x07" : self.hello,
+            b"\x09" : self.sendRanges,
+            b"\x0a" : self.sendStats,
+            b"\x0b" : self.sendStructureManifest,
         }
+        TRANSFERS = {self.sendFiles, self.sendDeltas, self.sendRanges} # Wait for a slot in the transfer scheduler first
+        COMPRESSED = {self.manifestComparison, self.configManifestComparison, self.sendFiles, self.sendStructureManifest} # The ones that take a codec after \x08
+        self.metrics.count("connections")
+        self.metrics.adjust("active_connections", 1)
+        t0 = time.perf_counter()
+        handler = None
+        admitted = False
         try:
+            codec = None
             what_you_want = await r.read(1)
-            await BYTE_MAP[what_you_want](r, w)
-        except ConnectionResetError:
-            pass
+            if what_you_want == b"\x08": # Compressed request, the codec name comes before the real opcode
+                name_length = (await r.readexactly(1))[0]
+                codec = (await r.readexactly(name_length)).decode("ascii", "replace")
+                if codec not in COMPRESSION_CODECS:
+                    raise ManifestError("Unsupported codec {}".format(codec))
+                what_you_want = await r.read(1)
+                if BYTE_MAP.get(what_you_want, None) not in COMPRESSED:
+                    raise ManifestError("Opcode {!r} does not take a codec".format(what_you_want))
+            handler = BYTE_MAP[what_you_want]
+            if handler in TRANSFERS:
+                await self.transfers.admit(peerName(w))
+                admitted = True
+            if codec:
+                await handler(r, w, codec=codec)
+            else:
+                await handler(r, w)
+        except (ConnectionResetError, asyncio.IncompleteReadError):
+            self.metrics.count("dropped_connections")
         except KeyError:
             pass
+        except ManifestError as e:
+            self.metrics.count("rejected_requests")
+            print("Rejected manifest from {}: {}".format(w.get_extra_info("peername"), e))
+        finally:
+            if admitted:
+                self.transfers.release()
+            self.metrics.adjust("active_connections", -1)
+            if handler is not None: # Comparison latency shows up as request_seconds/manifestComparison
+                self.metrics.observe("request_seconds/{}".format(handler.__name__), time.perf_counter() - t0)
+            w.close()
 
     async def run(self):
-        print("Analyzing rimworld...")
-        self.base_structure = generateStructure(".")
-        self.base_app_data_structure = generateStructure(AppDataStructure.getRimworldConfigArea(), app_data=AppDataStructure.getRimworldConfigArea())
+        setHashAlgorithm(commandLineValue("--hashalgorithm", "sha256")) # Every copy of rimlink has sha256, blake3 is only there if its package is installed
+        print("Analyzing rimworld with {}...".format(rimlink.HASH_ALGORITHM))
+        hash_cache = self.hash_cache = HashCache().load()
+        hashing_engine = self.hashing_engine = hashingEngine()
+        with self.metrics.timer("scan_seconds"):
+            self.base_structure = generateStructure(".", hash_cache=hash_cache, hashing_engine=hashing_engine)
+            self.base_app_data_structure = generateStructure(AppDataStructure.getRimworldConfigArea(), app_data=AppDataStructure.getRimworldConfigArea(), hash_cache=hash_cache, hashing_engine=hashing_engine)
+        reportHashCache(hash_cache)
+        self.watchAreas()
+        metrics_location = commandLineValue("--metricsdump", None)
+        if metrics_location:
+            asyncio.ensure_future(self.dumpMetrics(metrics_location, float(commandLineValue("--metricsinterval", 60))))
         print("Ready to receive connections on {}:{}".format(IP_ADDRESS, PORT))
         await asyncio.start_server(self._handle_client, IP_ADDRESS, PORT)
 
@@ -327,6 +1663,7 @@ def main():
         return client()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # The process pool hashing backend needs this once frozen into rimlink.exe
     try:
         main()
     except:
@@ -1,11 +1,23 @@
 from __future__ import unicode_literals
 
 import os
+import sys
 import ctypes
 import hashlib
+import json
+import mmap
 from filecmp import cmp
+from contextlib import nullcontext
+from stat import S_ISREG
+from threading import Lock
 
 SCRIPT_LOCATION = ""
+HASH_CACHE_FILE = "rimlink_hashes.cache"
+TRANSFER_JOURNAL_FILE = "rimlink_transfers.journal"
+HASH_ALGORITHM = "sha256" # Agreed with the host during the hello, see setHashAlgorithm
+MMAP_MIN_SIZE = 4*1024*1024 # Files at least this big are read a MB at a time. They are only mapped when asked to, a file truncated while mapped kills the process with SIGBUS
+PART_SUFFIX = ".rimlink-part" # Downloads land in a temporary file with this suffix and are renamed into place once verified
+UNHASHED = "unhashed" # Stands in for the digest of a file a lazy scan settled by size, never equal to a real digest
 
 
 def isAdmin(cmdLine=[]):
@@ -18,36 +30,83 @@ def isAdmin(cmdLine=[]):
         is_admin = True
     return is_admin
 
+NO_CHILDREN = () # Shared by every node without children, setChild swaps in a real list on first use
+
 class FileFolder:
+    # Slotted and with interned names to keep 100k+ node trees small. Folders cache their paths since every
+    # descendant asks for them, files build theirs from the cached parent path on demand.
+    __slots__ = ("name", "parent", "file", "children", "_path", "_relative_path")
+    CACHED_SLOTS = ("_path", "_relative_path")
+
     def __init__(self, name, parent=None, **kwargs):
         assert isinstance(name, str)
         assert parent is None or isinstance(parent, FileFolder), "Was {} instead".format(type(parent))
-        self.name = name
+        self.name = sys.intern(name)
         self.parent = None
+        self.file = None
+        self.children = NO_CHILDREN
+        self._path = None
+        self._relative_path = None
         if parent:
             parent.setChild(self)
-        if kwargs.get("isfile", os.path.isfile(self.path())):
+        isfile = kwargs.get("isfile", None)
+        if isfile is None:
+            isfile = os.path.isfile(self.path())
+        if isfile:
             self.file = True
         else:
             self.file = False
-        self.children = []
+            self.forgetPaths()
 
 
     def setChild(self, file):
         assert isinstance(file, FileFolder)
+        if self.children is NO_CHILDREN:
+            self.children = []
         self.children.append(file)
         file.parent = self
+        file.forgetPaths()
+
+    def forgetPaths(self): # Drops cached paths of this node and its descendants, needed if a subtree is moved
+        stack = [self]
+        while stack:
+            current = stack.pop()
+            current._path = None
+            current._relative_path = None
+            stack.extend(current.children)
 
     def path(self):
+        if self._path is not None:
+            return self._path
         if self.parent:
-            return os.path.join(self.parent.path(), self.name)
+            path = os.path.join(self.parent.path(), self.name)
         else:
-            return self.name
+            path = self.name
+        if self.file is False:
+            self._path = path
+        return path
     def relativePath(self):
+        if self._relative_path is not None:
+            return self._relative_path
         if self.parent:
-            return os.path.join(self.parent.relativePath(), self.name)
+            relative_path = os.path.join(self.parent.relativePath(), self.name)
         else:
-            return ""
+            relative_path = ""
+        if self.file is False:
+            self._relative_path = relative_path
+        return relative_path
+
+    @classmethod
+    def slotNames(cls):
+        return [x for klass in cls.__mro__ for x in getattr(klass, "__slots__", ())]
+
+    def __getstate__(self): # Cached paths are left out, they are only valid on the machine which built them
+        return {x : getattr(self, x) for x in self.slotNames() if x not in self.CACHED_SLOTS and hasattr(self, x)}
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+        self._path = None
+        self._relative_path = None
 
     def __str__(self):
         return self.path()
@@ -57,18 +116,44 @@ class FileFolder:
 
 
 
-def hashFile(givenFile):
+def hashAlgorithms(): # In order of preference, every one of them gives 32 byte digests so manifests keep their layout
+    algorithms = {}
+    try:
+        import blake3
+        algorithms["blake3"] = blake3.blake3
+    except ImportError:
+        pass
+    algorithms["sha256"] = hashlib.sha256 # Ahead of blake2b, with SHA extensions in most current CPUs it is the faster of the two
+    algorithms["blake2b"] = lambda: hashlib.blake2b(digest_size=32)
+    return algorithms
+
+HASH_ALGORITHMS = hashAlgorithms()
+
+def setHashAlgorithm(name):
+    global HASH_ALGORITHM
+    if name not in HASH_ALGORITHMS:
+        raise ValueError("Unsupported hash algorithm {}".format(name))
+    HASH_ALGORITHM = name
+
+def newHash(algorithm=None):
+    return HASH_ALGORITHMS[algorithm or HASH_ALGORITHM]()
+
+def hashFile(givenFile, algorithm=None, use_mmap=False): # Mods may be rewritten while the host hashes them, so use_mmap is for benchmarking only
     assert isinstance(givenFile, str)
-    h  = hashlib.sha256()
-    b  = bytearray(128*1024)
-    mv = memoryview(b)
+    h  = newHash(algorithm)
     if os.path.isdir(givenFile):
         return "folder"
     elif os.path.isfile(givenFile):
         try:
             with open(givenFile, 'rb', buffering=0) as f:
-                for n in iter(lambda : f.readinto(mv), 0):
-                    h.update(mv[:n])
+                size = os.fstat(f.fileno()).st_size
+                if size and use_mmap:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped: # No copies into Python buffers, the hash reads the page cache directly
+                        h.update(mapped)
+                else: # A file that shrinks meanwhile only reads short and hashes wrong, the next rescan catches up
+                    mv = memoryview(bytearray(1024*1024 if size >= MMAP_MIN_SIZE else 128*1024))
+                    for n in iter(lambda : f.readinto(mv), 0):
+                        h.update(mv[:n])
         except:
             return "permission_denied"
     else:
@@ -79,21 +164,220 @@ def compareFiles(file1, file2):
     return hashFile(file1) == hashFile(file2)
 
 
+class HashCache: # Hashes from earlier runs, trusted only while size, mtime_ns and inode still match. Stored as an append-only log of JSON lines
+    COMPACT_RATIO = 2
+    COMPACT_SLACK = 1000
+
+    def __init__(self, location=None):
+        self.location = location or HASH_CACHE_FILE
+        self.entries = {}
+        self.pending = []
+        self.logged = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def key(path):
+        return os.path.abspath(path)
+
+    @staticmethod
+    def signature(stat):
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def load(self):
+        self.entries = {}
+        self.logged = 0
+        try:
+            with open(self.location, "r", encoding="utf-8") as f:
+                for line in f:
+                    self.logged += 1
+                    try:
+                        fields = json.loads(line)
+                        path, size, mtime_ns, inode, digest = fields[:5]
+                    except (ValueError, TypeError):
+                        continue
+                    if digest is None:
+                        self.entries.pop(path, None)
+                    else:
+                        self.entries[path] = (size, mtime_ns, inode, digest, fields[5] if len(fields) > 5 else "sha256") # Older caches were all sha256
+        except FileNotFoundError:
+            pass
+        return self
+
+    def lookup(self, path, stat):
+        entry = self.entries.get(self.key(path))
+        with self.lock:
+            if entry and entry[:3] == self.signature(stat) and entry[4] == HASH_ALGORITHM:
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+        return None
+
+    def store(self, path, stat, digest):
+        key = self.key(path)
+        entry = self.signature(stat) + (digest, HASH_ALGORITHM)
+        with self.lock:
+            self.entries[key] = entry
+            self.pending.append([key, *entry])
+
+    def hashFile(self, givenFile):
+        try:
+            stat = os.stat(givenFile)
+        except OSError:
+            return hashFile(givenFile)
+        if not S_ISREG(stat.st_mode):
+            return hashFile(givenFile)
+        digest = self.lookup(givenFile, stat)
+        if digest is None:
+            digest = hashFile(givenFile)
+            if digest != "permission_denied":
+                self.store(givenFile, stat, digest)
+        return digest
+
+    def invalidate(self, path=None): # Forgets path and everything below it, or the whole cache if no path is given
+        with self.lock:
+            if path is None:
+                stale = list(self.entries.keys())
+            else:
+                key = self.key(path)
+                prefix = os.path.join(key, "")
+                stale = [x for x in self.entries.keys() if x == key or x.startswith(prefix)]
+            for x in stale:
+                del self.entries[x]
+                self.pending.append([x, None, None, None, None])
+        return len(stale)
+
+    def save(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if self.logged + len(pending) > self.COMPACT_RATIO * len(self.entries) + self.COMPACT_SLACK:
+            return self.compact(prune=False)
+        if pending:
+            with open(self.location, "a", encoding="utf-8") as f:
+                for line in pending:
+                    f.write(json.dumps(line) + "\n")
+            self.logged += len(pending)
+
+    def compact(self, prune=True): # Rewrites the log with only live entries, optionally dropping files that changed or vanished
+        with self.lock:
+            if prune:
+                for key, entry in list(self.entries.items()):
+                    try:
+                        stat = os.stat(key)
+                    except OSError:
+                        del self.entries[key]
+                        continue
+                    if entry[:3] != self.signature(stat):
+                        del self.entries[key]
+            self.pending = []
+            temp_location = self.location + ".tmp"
+            with open(temp_location, "w", encoding="utf-8") as f:
+                for key, entry in self.entries.items():
+                    f.write(json.dumps([key, *entry]) + "\n")
+            os.replace(temp_location, self.location)
+            self.logged = len(self.entries)
+
+    @property
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+RESUME_MIN_SIZE = 1024*1024 # Smaller downloads are simply started over
+
+class TransferJournal: # Partial downloads that can be picked up again, as an append-only log of JSON lines [part path, hash, size] or [part path, None, None] once finished
+    def __init__(self, location=None):
+        self.location = location or TRANSFER_JOURNAL_FILE
+        self.entries = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def key(path):
+        return os.path.abspath(path)
+
+    def load(self): # Also rewrites the log with only the parts that are still on disk
+        self.entries = {}
+        try:
+            with open(self.location, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        path, digest, size = json.loads(line)
+                    except ValueError:
+                        continue # A torn last line from an interrupted run
+                    if digest is None:
+                        self.entries.pop(path, None)
+                    else:
+                        self.entries[path] = (digest, size)
+        except FileNotFoundError:
+            pass
+        self.entries = {x : y for x, y in self.entries.items() if os.path.isfile(x)}
+        temp_location = self.location + ".tmp"
+        with open(temp_location, "w", encoding="utf-8") as f:
+            for path, (digest, size) in self.entries.items():
+                f.write(json.dumps([path, digest, size]) + "\n")
+        os.replace(temp_location, self.location)
+        return self
+
+    def append(self, line):
+        with open(self.location, "a", encoding="utf-8") as f:
+            f.write(json.dumps(line) + "\n")
+
+    def begin(self, part_path, digest, size): # Written before the first byte so a crash at any point leaves a usable record
+        key = self.key(part_path)
+        with self.lock:
+            if self.entries.get(key, None) != (digest, size):
+                self.entries[key] = (digest, size)
+                self.append([key, digest, size])
+
+    def finish(self, part_path):
+        key = self.key(part_path)
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.append([key, None, None])
+
+    def offset(self, part_path, digest, size): # Bytes already on disk for this exact content, 0 if it has to start over
+        with self.lock:
+            if self.entries.get(self.key(part_path), None) != (digest, size):
+                return 0
+        try:
+            return min(os.path.getsize(part_path), size)
+        except OSError:
+            return 0
+
+
 class HashStructure(FileFolder):
+    __slots__ = ("hash", "size", "digest")
+
     def __init__(self, name, parent=None, **kwargs):
         super(HashStructure, self).__init__(name, parent, **kwargs)
+        hash_cache = kwargs.get("hash_cache", None)
+        self.size = kwargs.get("size", None)
+        if self.size is None:
+            try:
+                self.size = os.path.getsize(self.path()) if self.file else 0
+            except OSError:
+                self.size = 0
+        self.digest = None # Set by computeDigests, for folders it covers the names and digests of everything below
         if name == ".":
             self.hash = "head"
+        elif kwargs.get("defer_hash", False): # Filled in later by a HashingEngine
+            self.hash = None if self.file else "folder"
+        elif hash_cache is not None:
+            self.hash = hash_cache.hashFile(self.path())
         else:
             self.hash = hashFile(self.path())
 
 class AppDataStructure(HashStructure):
+    __slots__ = ()
+
     def __init__(self, name, parent=None, **kwargs):
         super(AppDataStructure, self).__init__(name, parent, **kwargs)
 
-    def path(self):
-        if self.parent:
-            return os.path.join(self.parent.path(), self.name)
+    def path(self): # Never cached, the config area is looked up again each time as it differs between machines
+        relative_path = self.relativePath()
+        if relative_path:
+            return os.path.join(AppDataStructure.getRimworldConfigArea(), relative_path)
         else:
             return AppDataStructure.getRimworldConfigArea()
     @staticmethod
@@ -109,20 +393,82 @@ class AppDataStructure(HashStructure):
             
 
 
-FILE_EXCEPTIONS = {"__pycache__", "Saves", "Scenarios", "MpReplays", "MpDesyncs", "Player.log", "Player-prev.log", ".gitignore", ".git", "rimlink.exe", "MonoBleedingEdge"}
+FILE_EXCEPTIONS = {"__pycache__", "Saves", "Scenarios", "MpReplays", "MpDesyncs", "Player.log", "Player-prev.log", ".gitignore", ".git", "rimlink.exe", "MonoBleedingEdge", HASH_CACHE_FILE, HASH_CACHE_FILE + ".tmp", TRANSFER_JOURNAL_FILE, TRANSFER_JOURNAL_FILE + ".tmp"}
 
 from threading import Thread
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import time
 
 
+def hashFiles(givenFiles, algorithm=None): # Runs inside the pool workers of a HashingEngine, so it has to stay a module level function
+    return [hashFile(x, algorithm) for x in givenFiles]
+
+class HashingEngine:
+    BACKENDS = {
+        "thread" : ThreadPoolExecutor,
+        "process" : ProcessPoolExecutor,
+    }
+    BATCH_BYTES = 64*1024*1024
+
+    def __init__(self, backend="thread", workers=None, batch_size=64):
+        assert backend in self.BACKENDS, "Unknown hashing backend {}".format(backend)
+        assert batch_size > 0
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 2
+        self.batch_size = batch_size
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.files_settled = 0 # Files a lazy scan knew were different without hashing them
+
+    def batches(self, to_hash): # A batch is closed by file count or by bytes, so one huge file does not drag a batch of small ones along with it
+        batch = []
+        batch_bytes = 0
+        for item in to_hash:
+            batch.append(item)
+            batch_bytes += item[0].size
+            if len(batch) >= self.batch_size or batch_bytes >= self.BATCH_BYTES:
+                yield batch
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield batch
+
+    def finishBatch(self, batch, digests, hash_cache):
+        for (structure, stat), digest in zip(batch, digests):
+            structure.hash = digest
+            self.files_hashed += 1
+            self.bytes_hashed += structure.size
+            if hash_cache is not None and stat is not None and digest != "permission_denied":
+                hash_cache.store(structure.path(), stat, digest)
+
+    def hashStructures(self, to_hash, hash_cache=None): # to_hash holds (structure, stat) pairs, stat may be None if the cache should not be updated
+        # Largest first, so a multi-GB file found at the end of the walk does not start last and leave the other workers idle
+        batches = list(self.batches(sorted(to_hash, key=lambda x: x[0].size, reverse=True)))
+        if not batches:
+            return
+        if len(batches) == 1 or self.workers == 1:
+            for batch in batches:
+                self.finishBatch(batch, hashFiles([x[0].path() for x in batch]), hash_cache)
+            return
+        with self.BACKENDS[self.backend](max_workers=self.workers) as executor:
+            futures = {executor.submit(hashFiles, [x[0].path() for x in batch], HASH_ALGORITHM) : batch for batch in batches} # Spawned workers do not see setHashAlgorithm
+            for future in as_completed(futures):
+                self.finishBatch(futures[future], future.result(), hash_cache)
+
+
 class StructureBuilder:
     def __init__(self, relativePositionStart, parent=None, **kwargs):
         self.relativePositionStart = relativePositionStart
         self.parent = parent
         self.app_data = kwargs.get("app_data", False)
-        self.MAX_THREADS = os.cpu_count() - 2 or 2
-        self.TO_COMPLETE = Queue()
+        self.hash_cache = kwargs.get("hash_cache", None)
+        self.hashing_engine = kwargs.get("hashing_engine", None) or HashingEngine()
+        self.expected_sizes = kwargs.get("expected_sizes", None) # Portable path to size of the other side's files, only files found at the same size get hashed
+        self.MAX_THREADS = max((os.cpu_count() or 4) - 2, 2)
+        self.TO_COMPLETE = Queue() # Every put is matched by a task_done, so join returns once the whole walk is done
+        self.TO_HASH = []
+        self.errors = []
         if self.app_data:
             self.structureType = AppDataStructure
         else:
@@ -143,38 +489,62 @@ class StructureBuilder:
         @property
         def structureType(self):
             return self.mainBuilder.structureType
+        @property
+        def hashCache(self):
+            return self.mainBuilder.hash_cache
 
-        def execute(self):
-            for file_name in self.listdir or os.listdir(self.start):
-                if file_name in FILE_EXCEPTIONS:
-                    continue
-                file_name_path = os.path.join(self.start, file_name)
-                isfile = os.path.isfile(file_name_path)
-                newStructure = self.structureType(file_name, self.parent, app_data=self.appData, isfile=isfile)
-                if not isfile:
-                    listdir = os.listdir(file_name_path)
-                    if len(listdir) <= 1:
-                        self.mainBuilder.SubstructureBuilder(file_name_path, self.mainBuilder, newStructure, listdir=listdir).execute()
+        def execute(self): # Only walks, hashing is left to the HashingEngine once the walk is complete
+            with os.scandir(self.start) if self.listdir is None else nullcontext(self.listdir) as entries:
+                for entry in entries:
+                    if entry.name in FILE_EXCEPTIONS or entry.name.endswith(PART_SUFFIX):
+                        continue
+                    isfile = entry.is_file()
+                    stat = os.stat(entry.path) if isfile else None # DirEntry.stat has no inode on Windows, the cache is keyed on the same os.stat as everywhere else
+                    newStructure = self.structureType(entry.name, self.parent, app_data=self.appData, isfile=isfile, size=stat.st_size if isfile else 0, defer_hash=True)
+                    if isfile:
+                        cached = self.hashCache.lookup(entry.path, stat) if self.hashCache is not None else None
+                        if cached is None:
+                            self.mainBuilder.TO_HASH.append((newStructure, stat))
+                        else:
+                            newStructure.hash = cached
                     else:
-                        self.mainBuilder.generateSubstructure(file_name_path, newStructure)
+                        with os.scandir(entry.path) as inner_entries:
+                            listdir = list(inner_entries)
+                        if len(listdir) <= 1:
+                            self.mainBuilder.SubstructureBuilder(entry.path, self.mainBuilder, newStructure, listdir=listdir).execute()
+                        else:
+                            self.mainBuilder.generateSubstructure(entry.path, newStructure)
 
     class StructureExecutor(Thread):
-        def __init__(self, todoQ):
+        def __init__(self, todoQ, errors):
             self.todoQ = todoQ
-            self.waiting = True
-            super(StructureBuilder.StructureExecutor, self).__init__()
+            self.errors = errors
+            super(StructureBuilder.StructureExecutor, self).__init__(daemon=True)
 
         def run(self):
             while True:
-                self.waiting = True
                 substructureBuilder = self.todoQ.get()
-                self.waiting = False
-                if not substructureBuilder:
-                    return
-                substructureBuilder.execute()
+                try:
+                    if not substructureBuilder:
+                        return
+                    substructureBuilder.execute() # Queues any subfolders before this task is marked done
+                except Exception as e:
+                    self.errors.append(e)
+                finally:
+                    self.todoQ.task_done()
 
                 
    
+    def settleBySize(self): # A file missing on the other side or with another size is a difference whatever its contents, so it is never read
+        to_hash = []
+        for structure, stat in self.TO_HASH:
+            if self.expected_sizes.get(portablePath(structure)) == structure.size:
+                to_hash.append((structure, stat))
+            else:
+                structure.hash = UNHASHED
+        self.hashing_engine.files_settled += len(self.TO_HASH) - len(to_hash)
+        self.TO_HASH = to_hash
+
     def generateSubstructure(self, file_name_path, parent=None):
         if not parent:
             parent = self.parent
@@ -182,23 +552,26 @@ class StructureBuilder:
 
     def run(self):
         if not self.parent:
-            self.parent = self.structureType(self.relativePositionStart, None, app_data=self.app_data)
+            self.parent = self.structureType(self.relativePositionStart, None, app_data=self.app_data, hash_cache=self.hash_cache)
         self.generateSubstructure(self.relativePositionStart)
         EXEUCTOR_QUEUES = []
         for _ in range(self.MAX_THREADS):
-            EXEUCTOR_QUEUES.append(self.StructureExecutor(self.TO_COMPLETE))
+            EXEUCTOR_QUEUES.append(self.StructureExecutor(self.TO_COMPLETE, self.errors))
         for x in EXEUCTOR_QUEUES:
             x.start()
 
-        while True:
-            if self.TO_COMPLETE.qsize() == 0:
-                if all(thread.waiting for thread in EXEUCTOR_QUEUES):
-                    break
-            time.sleep(.01)
-
+        self.TO_COMPLETE.join()
         for _ in range(self.MAX_THREADS):
             self.TO_COMPLETE.put(None)
-        # self.TO_COMPLETE.join()
+        for x in EXEUCTOR_QUEUES:
+            x.join()
+        if self.errors:
+            raise self.errors[0]
+        if self.expected_sizes is not None:
+            self.settleBySize()
+        self.hashing_engine.hashStructures(self.TO_HASH, self.hash_cache)
+        self.TO_HASH = []
+        computeDigests(self.parent)
         return self.parent
 
 
@@ -208,59 +581,975 @@ def generateStructure(relativePositionStart, parent=None, **kwargs):
 
 def getAllChildren(structure): # Includes the structure which initially calls the function as well
     assert isinstance(structure, FileFolder)
-    return_list = [structure,]
-    if structure.children:
-        for child in structure.children:
-            return_list.extend(getAllChildren(child))
+    return_list = []
+    stack = [structure]
+    while stack:
+        current = stack.pop()
+        return_list.append(current)
+        stack.extend(reversed(current.children))
     return return_list
 
-def compareStructures(baseStructure, otherStructure, head=True):
-    assert isinstance(baseStructure, HashStructure), "got {} instead".format(type(baseStructure))
-    assert isinstance(otherStructure, HashStructure), "got {} instead".format(type(otherStructure))
+def folderDigest(structure):
+    h = newHash()
+    for child in sorted(structure.children, key=lambda x: x.name):
+        h.update(child.name.encode("utf-8", "surrogateescape"))
+        h.update(b"\x00f" if child.file else b"\x00d")
+        h.update(str(child.digest).encode())
+        h.update(b"\x00")
+    return h.hexdigest()
 
-    to_add = []
-    to_modify = []
-    to_delete = []
+def computeDigests(structure): # Post-order so every folder sees the finished digests of its children
+    assert isinstance(structure, FileFolder)
+    stack = [(structure, False)]
+    while stack:
+        current, children_done = stack.pop()
+        if not isinstance(current, HashStructure): # A plain FileFolder given as the parent of a build
+            if not children_done:
+                stack.extend((x, False) for x in current.children)
+        elif current.file:
+            current.digest = current.hash
+        elif children_done:
+            current.digest = folderDigest(current)
+        else:
+            stack.append((current, True))
+            stack.extend((x, False) for x in current.children)
+    return getattr(structure, "digest", None)
+
+def digestsMatch(baseStructure, otherStructure):
+    base_digest = getattr(baseStructure, "digest", None)
+    return base_digest is not None and base_digest == getattr(otherStructure, "digest", None)
 
-    assert isinstance(to_add, list)
-    assert isinstance(to_modify, list)
-    assert isinstance(to_delete, list)
+def structuresMatch(baseStructure, otherStructure): # One-shot check that two trees are already in sync
+    assert isinstance(baseStructure, HashStructure), "got {} instead".format(type(baseStructure))
+    assert isinstance(otherStructure, HashStructure), "got {} instead".format(type(otherStructure))
+    return digestsMatch(baseStructure, otherStructure)
 
+def iterDifferences(baseStructure, otherStructure, head=True): # Yields (section, structure) pairs as the walk finds them
+    assert isinstance(baseStructure, HashStructure), "got {} instead".format(type(baseStructure))
+    assert isinstance(otherStructure, HashStructure), "got {} instead".format(type(otherStructure))
+    if head and digestsMatch(baseStructure, otherStructure):
+        return
 
-    other_structure_dict = {}
+    other_structure_dict = {} # Keyed on name, siblings share their parent's relative path on both sides
     for item in otherStructure.children:
-        other_structure_dict[item.relativePath()] = item
+        other_structure_dict[item.name] = item
 
     for item in baseStructure.children:
-        if item.relativePath() in other_structure_dict.keys():
-            other_item = other_structure_dict[item.relativePath()]
-            item_hash = item.hash
-            other_hash = other_item.hash
-            if item_hash != other_hash:
-                to_modify.append(item)
-            del other_structure_dict[item.relativePath()]
-            if item.children:
-                results = compareStructures(item, other_item, False)
-                to_add.extend(results['add'])
-                to_modify.extend(results['modify'])
-                to_delete.extend(results['delete'])
+        if item.name in other_structure_dict:
+            other_item = other_structure_dict[item.name]
+            if item.hash != other_item.hash:
+                yield "modify", item
+            del other_structure_dict[item.name]
+            if item.children and not (other_item.children and digestsMatch(item, other_item)): # Identical subtrees are skipped whole
+                yield from iterDifferences(item, other_item, False)
         else:
-            to_add.extend(getAllChildren(item))
-            
+            for child in getAllChildren(item):
+                yield "add", child
+
     for item in other_structure_dict.values():
-        to_delete.append(item)
-
-    if head:
-        return {
-            "delete" : [x for x in to_delete],
-            "modify" : [x for x in to_modify],
-            "add" : [x for x in to_add],
-        }      
-    else:
-        return {
-            "delete" : to_delete,
-            "modify" : to_modify,
-            "add" : to_add,
-        }      
+        yield "delete", item
+
+def compareStructures(baseStructure, otherStructure, head=True):
+    differences = {
+        "delete" : [],
+        "modify" : [],
+        "add" : [],
+    }
+    for section, structure in iterDifferences(baseStructure, otherStructure, head):
+        differences[section].append(structure)
+    return differences
+
+
+
+
+import struct
+from collections import namedtuple
+
+# Binary manifest: a header, then one record per path and an end record. Paths are "/" separated, relative to the
+# structure's head and front-coded against the previous record, digests are stored raw at a fixed width.
+MANIFEST_MAGIC = b"RLMF"
+MANIFEST_VERSION = 2
+MANIFEST_HEADER = struct.Struct(">4sBB") # magic, version, digest size. From version 2 followed by a length prefixed hash algorithm name
+MANIFEST_RECORD = struct.Struct(">BBHHQ") # kind, section, shared prefix length, suffix length, size (record count in the end record)
+MANIFEST_MAX_DIGEST = 64
+MANIFEST_CHUNK = 64*1024
+MANIFEST_END, MANIFEST_FILE, MANIFEST_FOLDER, MANIFEST_UNREADABLE = range(4)
+MANIFEST_SECTIONS = ("structure", "delete", "modify", "add")
+
+ManifestEntry = namedtuple("ManifestEntry", ["section", "kind", "path", "size", "digest"])
+
+class ManifestError(ValueError):
+    pass
+
+def portablePath(structure):
+    relative_path = structure.relativePath()
+    if os.sep != "/":
+        relative_path = relative_path.replace(os.sep, "/")
+    return relative_path
+
+def validManifestPath(path): # Refuses anything that could escape the head of the structure it is applied to
+    if not path or "\x00" in path or "\\" in path or ":" in path:
+        return False
+    return all(part not in ("", ".", "..") for part in path.split("/"))
+
+def manifestEntry(structure, section="structure"):
+    assert isinstance(structure, HashStructure)
+    if not structure.file:
+        return ManifestEntry(section, MANIFEST_FOLDER, portablePath(structure), 0, structure.digest)
+    if structure.hash == "permission_denied":
+        return ManifestEntry(section, MANIFEST_UNREADABLE, portablePath(structure), structure.size, None)
+    return ManifestEntry(section, MANIFEST_FILE, portablePath(structure), structure.size, structure.hash)
+
+def structureEntries(structure, section="structure"): # Parents come before their children, siblings sorted by name
+    stack = sorted(structure.children, key=lambda x: x.name, reverse=True)
+    while stack:
+        current = stack.pop()
+        yield manifestEntry(current, section)
+        stack.extend(sorted(current.children, key=lambda x: x.name, reverse=True))
+
+def fileSizes(structure): # What a lazy scan against this structure needs, see StructureBuilder.settleBySize
+    return {portablePath(x) : x.size for x in getAllChildren(structure) if x.file}
+
+def differenceEntries(differences): # Takes compareStructures results, or (section, structure) pairs from iterDifferences to keep them in walk order
+    if isinstance(differences, dict):
+        for section in ("delete", "modify", "add"):
+            for structure in differences[section]:
+                yield manifestEntry(structure, section)
+        return
+    for section, structure in differences:
+        yield manifestEntry(structure, section)
+
+class ManifestWriter:
+    def __init__(self, digest_size=32, algorithm=None):
+        assert 0 < digest_size <= MANIFEST_MAX_DIGEST
+        self.digest_size = digest_size
+        self.algorithm = algorithm or HASH_ALGORITHM
+        self.previous = b""
+        self.count = 0
+
+    def packDigest(self, digest):
+        try:
+            raw = bytes.fromhex(digest)
+        except (TypeError, ValueError):
+            raw = b""
+        if len(raw) != self.digest_size:
+            return bytes(self.digest_size)
+        return raw
+
+    def header(self):
+        algorithm = self.algorithm.encode("ascii")
+        return MANIFEST_HEADER.pack(MANIFEST_MAGIC, MANIFEST_VERSION, self.digest_size) + bytes([len(algorithm)]) + algorithm
+
+    def record(self, entry):
+        path = entry.path.encode("utf-8", "surrogateescape")
+        shared = min(len(os.path.commonprefix([self.previous, path])), 0xFFFF)
+        suffix = path[shared:]
+        if len(suffix) > 0xFFFF:
+            raise ManifestError("Path too long for a manifest: {}".format(entry.path))
+        kind = entry.kind
+        if kind == MANIFEST_FILE and len(self.packDigest(entry.digest).strip(b"\x00")) == 0:
+            kind = MANIFEST_UNREADABLE
+        self.previous = path
+        self.count += 1
+        return MANIFEST_RECORD.pack(kind, MANIFEST_SECTIONS.index(entry.section), shared, len(suffix), entry.size) + suffix + self.packDigest(entry.digest)
+
+    def end(self, root_digest=None):
+        return MANIFEST_RECORD.pack(MANIFEST_END, 0, 0, 0, self.count) + self.packDigest(root_digest)
+
+def encodeManifest(entries, root_digest=None, digest_size=32, algorithm=None): # Yields chunks of about MANIFEST_CHUNK bytes so callers can stream them
+    writer = ManifestWriter(digest_size, algorithm)
+    chunk = [writer.header()]
+    chunk_size = len(chunk[0])
+    for entry in entries:
+        record = writer.record(entry)
+        chunk.append(record)
+        chunk_size += len(record)
+        if chunk_size >= MANIFEST_CHUNK:
+            yield b"".join(chunk)
+            chunk = []
+            chunk_size = 0
+    chunk.append(writer.end(root_digest))
+    yield b"".join(chunk)
+
+class ManifestReader: # Incremental parser, feed() takes whatever the socket returned and gives back the finished entries
+    def __init__(self):
+        self.buffer = bytearray()
+        self.digest_size = None
+        self.previous = b""
+        self.count = 0
+        self.done = False
+        self.root_digest = None
+        self.algorithm = None
+
+    def unpackDigest(self, raw):
+        if not any(raw):
+            return None
+        return raw.hex()
+
+    def feed(self, data):
+        if self.done:
+            if data:
+                raise ManifestError("Data after the end of the manifest")
+            return []
+        self.buffer += data
+        entries = []
+        offset = 0
+        if self.digest_size is None:
+            if len(self.buffer) < MANIFEST_HEADER.size:
+                return entries
+            magic, version, digest_size = MANIFEST_HEADER.unpack_from(self.buffer)
+            if magic != MANIFEST_MAGIC:
+                raise ManifestError("Not a manifest")
+            if version not in (1, MANIFEST_VERSION):
+                raise ManifestError("Unsupported manifest version {}".format(version))
+            if not 0 < digest_size <= MANIFEST_MAX_DIGEST:
+                raise ManifestError("Invalid digest size {}".format(digest_size))
+            offset = MANIFEST_HEADER.size
+            if version == 1:
+                algorithm = "sha256"
+            else:
+                if len(self.buffer) < offset + 1 or len(self.buffer) < offset + 1 + self.buffer[offset]:
+                    return entries
+                algorithm = bytes(self.buffer[offset + 1:offset + 1 + self.buffer[offset]]).decode("ascii", "replace")
+                offset += 1 + self.buffer[offset]
+            self.algorithm = algorithm
+            self.digest_size = digest_size
+        while True:
+            if len(self.buffer) - offset < MANIFEST_RECORD.size:
+                break
+            kind, section, shared, suffix_length, size = MANIFEST_RECORD.unpack_from(self.buffer, offset)
+            record_length = MANIFEST_RECORD.size + suffix_length + self.digest_size
+            if len(self.buffer) - offset < record_length:
+                break
+            start = offset + MANIFEST_RECORD.size
+            suffix = bytes(self.buffer[start:start + suffix_length])
+            digest = self.unpackDigest(bytes(self.buffer[start + suffix_length:offset + record_length]))
+            offset += record_length
+            if kind == MANIFEST_END:
+                if size != self.count:
+                    raise ManifestError("Manifest ended after {} of {} records".format(self.count, size))
+                self.root_digest = digest
+                self.done = True
+                break
+            if kind not in (MANIFEST_FILE, MANIFEST_FOLDER, MANIFEST_UNREADABLE) or section >= len(MANIFEST_SECTIONS):
+                raise ManifestError("Invalid manifest record")
+            if shared > len(self.previous):
+                raise ManifestError("Invalid path prefix in manifest")
+            raw_path = self.previous[:shared] + suffix
+            path = raw_path.decode("utf-8", "surrogateescape")
+            if not validManifestPath(path):
+                raise ManifestError("Unsafe path in manifest: {!r}".format(path))
+            self.previous = raw_path
+            self.count += 1
+            if kind == MANIFEST_UNREADABLE:
+                digest = "permission_denied"
+            entries.append(ManifestEntry(MANIFEST_SECTIONS[section], kind, path, size, digest))
+        del self.buffer[:offset]
+        return entries
+
+def decodeManifest(data):
+    reader = ManifestReader()
+    entries = reader.feed(data)
+    if not reader.done:
+        raise ManifestError("Manifest is incomplete")
+    if reader.buffer:
+        raise ManifestError("Data after the end of the manifest")
+    return entries, reader.root_digest
+
+def checkManifestAlgorithm(reader): # Digests made with another algorithm would make every file look changed
+    if reader.algorithm != HASH_ALGORITHM:
+        raise ManifestError("Manifest was hashed with {}, this side uses {}".format(reader.algorithm, HASH_ALGORITHM))
+
+class ManifestTree: # Builds nodes straight from manifest entries without touching the disk, a batch at a time as they arrive
+    def __init__(self, root):
+        assert isinstance(root, HashStructure)
+        self.structureType = type(root)
+        self.nodes = {"" : root}
+
+    def folderFor(self, path):
+        if path in self.nodes:
+            return self.nodes[path]
+        parent_path, _, name = path.rpartition("/")
+        folder = self.structureType(name, self.folderFor(parent_path), isfile=False, size=0, defer_hash=True)
+        self.nodes[path] = folder
+        return folder
+
+    def add(self, entries): # Returns (entry, node) pairs
+        built = []
+        for entry in entries:
+            node = self.nodes.get(entry.path, None)
+            if node is None or node.file != (entry.kind != MANIFEST_FOLDER):
+                parent_path, _, name = entry.path.rpartition("/")
+                node = self.structureType(name, self.folderFor(parent_path), isfile=entry.kind != MANIFEST_FOLDER, size=entry.size, defer_hash=True)
+                self.nodes[entry.path] = node
+            if entry.kind == MANIFEST_FOLDER:
+                node.hash = "folder"
+            else:
+                node.hash = entry.digest
+            node.size = entry.size
+            node.digest = entry.digest
+            built.append((entry, node))
+        return built
+
+def structureFromEntries(entries, root):
+    return ManifestTree(root).add(entries)
+
+def structureFromManifest(entries, root, root_digest=None):
+    structureFromEntries(entries, root)
+    root.digest = root_digest
+    return root
+
+def differencesFromManifest(entries, root):
+    differences = {
+        "delete" : [],
+        "modify" : [],
+        "add" : [],
+    }
+    for entry, node in structureFromEntries(entries, root):
+        differences[entry.section].append(node)
+    return differences
+
+def structureIndex(structure): # Maps the portable path of every node below structure to the node
+    return {portablePath(x) : x for x in getAllChildren(structure) if x is not structure}
+
+def partitionBySize(structures, bins): # Largest first onto the lightest bin, so every bin ends up with about the same number of bytes
+    import heapq
+    partitions = [[] for _ in range(max(bins, 1))]
+    loads = [(0, i) for i in range(len(partitions))]
+    for structure in sorted(structures, key=lambda x: x.size, reverse=True):
+        load, i = heapq.heappop(loads)
+        partitions[i].append(structure)
+        heapq.heappush(loads, (load + structure.size, i))
+    return [x for x in partitions if x]
+
+
+import zlib
+
+# rsync style deltas: the client signs the blocks of its copy, the host answers with copy instructions for blocks
+# the client already has and literal data for everything else
+DELTA_MIN_SIZE = 256*1024 # Below this a full transfer is cheaper than the signature round trip
+DELTA_ROLL_LIMIT = 4*1024*1024 # After this many unmatched bytes only block aligned offsets are probed
+DELTA_LITERAL_LIMIT = 1024*1024
+DELTA_READ = 1024*1024 # computeDelta reads the file this much at a time
+DELTA_SIGNATURE = struct.Struct(">I16s") # weak checksum, strong checksum
+ADLER_MOD = 65521
+
+def deltaBlockSize(size):
+    block_size = int(size ** 0.5) // 1024 * 1024
+    return min(max(block_size, 4096), 128*1024)
+
+def strongChecksum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def blockSignatures(givenFile, block_size):
+    signatures = []
+    with open(givenFile, "rb") as f:
+        for block in iter(lambda : f.read(block_size), b""):
+            signatures.append((zlib.adler32(block), strongChecksum(block)))
+    return signatures
+
+def computeDelta(givenFile, block_size, signatures, source_size):
+    # Yields ("copy", block index) and ("data", bytes) instructions that rebuild givenFile from a source of source_size
+    # bytes whose blocks have the given signatures. A short last block of the source can only match the very end.
+    tail_length = source_size - (len(signatures) - 1) * block_size if signatures else block_size
+    full_blocks = len(signatures) if tail_length == block_size else len(signatures) - 1
+    strong_index = {}
+    for i in range(full_blocks):
+        strong_index.setdefault(signatures[i], i)
+    weak_index = {weak for weak, _ in strong_index}
+    with open(givenFile, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        data = bytearray() # The file from base on. Read rather than mapped, a file truncated while mapped kills the process with SIGBUS
+        base = 0
+        def fill(end, keep): # Reads on until data reaches end, dropping what lies before keep
+            nonlocal base
+            if keep - base >= DELTA_READ:
+                del data[:keep - base]
+                base = keep
+            while base + len(data) < end:
+                piece = f.read(DELTA_READ)
+                if not piece:
+                    raise OSError("{} got shorter while its delta was worked out".format(givenFile))
+                data.extend(piece)
+        pos = 0
+        literal_start = 0
+        unmatched_start = 0
+        rolling = False
+        while pos + block_size <= size:
+            if base + len(data) <= pos + block_size and base + len(data) < size: # One byte past the block for rolling
+                fill(min(size, pos + block_size + 1), literal_start)
+            if not rolling:
+                adler = zlib.adler32(data[pos - base:pos + block_size - base])
+                a = adler & 0xFFFF
+                b = adler >> 16
+                rolling = True
+            weak = (b << 16) | a
+            if weak in weak_index:
+                match = strong_index.get((weak, strongChecksum(data[pos - base:pos + block_size - base])), None)
+                if match is not None:
+                    if literal_start < pos:
+                        yield ("data", bytes(data[literal_start - base:pos - base]))
+                    yield ("copy", match)
+                    pos += block_size
+                    literal_start = unmatched_start = pos
+                    rolling = False
+                    continue
+            if pos - literal_start >= DELTA_LITERAL_LIMIT:
+                yield ("data", bytes(data[literal_start - base:pos - base]))
+                literal_start = pos
+            if pos - unmatched_start >= DELTA_ROLL_LIMIT: # Rolling byte by byte is slow in Python, so long changed stretches are only probed per block
+                pos += block_size
+                rolling = False
+            elif pos + block_size < size:
+                out_byte = data[pos - base]
+                in_byte = data[pos + block_size - base]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                pos += 1
+            else:
+                break
+        fill(size, literal_start)
+        end = size
+        if full_blocks < len(signatures) and size - literal_start >= tail_length:
+            candidate = data[size - tail_length - base:size - base]
+            if (zlib.adler32(candidate), strongChecksum(candidate)) == signatures[-1]:
+                end = size - tail_length
+        while literal_start < end:
+            yield ("data", bytes(data[literal_start - base:min(end, literal_start + DELTA_LITERAL_LIMIT) - base]))
+            literal_start = min(end, literal_start + DELTA_LITERAL_LIMIT)
+        if end < size:
+            yield ("copy", len(signatures) - 1)
+
+def applyDelta(source, instructions, block_size, destination, hasher=None): # Rebuilds a file from an open source file and delta instructions
+    for kind, value in instructions:
+        if kind == "copy":
+            source.seek(value * block_size)
+            data = source.read(block_size)
+        else:
+            data = value
+        if hasher:
+            hasher.update(data)
+        destination.write(data)
+
+
+# Compression is negotiated per session. The preferred codec comes first, zstd is only offered if the optional
+# zstandard package is installed. Formats that are already compressed are sent as they are.
+COMPRESSED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".dds", ".ogg", ".mp3", ".zip", ".7z", ".rar", ".gz", ".xz", ".bz2", ".zst", ".psd", ".bundle", ".unity3d"}
+COMPRESSION_MIN_SIZE = 256
+ZLIB_LEVEL = 6
+
+def compressionCodecs():
+    codecs = {}
+    try:
+        import zstandard
+        codecs["zstd"] = (lambda : zstandard.ZstdCompressor(level=3).compressobj(), lambda : zstandard.ZstdDecompressor().decompressobj())
+    except ImportError:
+        pass
+    codecs["zlib"] = (lambda : zlib.compressobj(ZLIB_LEVEL), zlib.decompressobj)
+    return codecs
+
+COMPRESSION_CODECS = compressionCodecs()
+
+def chooseCodec(offered): # The first of our codecs, in preference order, that the other side also offered
+    for name in COMPRESSION_CODECS:
+        if name in offered:
+            return name
+    return None
+
+def shouldCompress(name, size):
+    return size >= COMPRESSION_MIN_SIZE and os.path.splitext(name)[1].lower() not in COMPRESSED_EXTENSIONS
+
+class CompressionStats:
+    def __init__(self):
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.seconds = 0.0
+        self.lock = Lock()
+
+    def compressor(self, codec):
+        return TimedCodec(COMPRESSION_CODECS[codec][0](), self)
+
+    def decompressor(self, codec):
+        return TimedCodec(COMPRESSION_CODECS[codec][1](), self)
+
+    def add(self, raw_bytes, wire_bytes, seconds):
+        with self.lock:
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.seconds += seconds
+
+    @property
+    def ratio(self):
+        return self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+    def __str__(self):
+        return "{:.1f} MB compressed to {:.1f} MB ({:.0%}) in {:.2f}s of CPU".format(self.raw_bytes / 1e6, self.wire_bytes / 1e6, self.ratio, self.seconds)
+
+class TimedCodec: # Wraps a compressobj/decompressobj so its CPU time and byte counts end up in a CompressionStats
+    def __init__(self, codec_obj, stats):
+        self.codec_obj = codec_obj
+        self.stats = stats
+
+    def compress(self, data):
+        t0 = time.thread_time()
+        result = self.codec_obj.compress(data)
+        self.stats.add(len(data), len(result), time.thread_time() - t0)
+        return result
+
+    def decompress(self, data, piece_size=1024*1024): # Yields the output in bounded pieces where the codec allows it, so a small frame cannot balloon in memory
+        t0 = time.thread_time()
+        wire_bytes = len(data)
+        if hasattr(self.codec_obj, "unconsumed_tail"):
+            while data:
+                result = self.codec_obj.decompress(data, piece_size)
+                data = self.codec_obj.unconsumed_tail
+                self.stats.add(len(result), wire_bytes, time.thread_time() - t0)
+                wire_bytes = 0
+                yield result
+                t0 = time.thread_time()
+        else:
+            result = self.codec_obj.decompress(data)
+            self.stats.add(len(result), wire_bytes, time.thread_time() - t0)
+            yield result
+
+    def flush(self):
+        t0 = time.thread_time()
+        result = self.codec_obj.flush()
+        self.stats.add(0, len(result), time.thread_time() - t0)
+        return result
+
+
+from collections import OrderedDict
+
+DIFF_CACHE_BYTES = 64*1024*1024
+
+class DiffCache: # Serialized comparison results keyed by a digest of the manifest that produced them, least recently used evicted first
+    def __init__(self, max_bytes=DIFF_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> (base structure it was computed against, payload)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def lookup(self, key, base):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] is base:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None: # Computed against a base structure that has since been replaced
+                self.discard(key)
+            self.misses += 1
+            return None
+
+    def store(self, key, base, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.discard(key)
+            self.entries[key] = (base, payload)
+            self.total_bytes += len(payload)
+            while self.total_bytes > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def discard(self, key):
+        self.total_bytes -= len(self.entries.pop(key)[1])
+
+    def invalidate(self, base=None): # Drops every result, or only those computed against base
+        with self.lock:
+            for key in [k for k, v in self.entries.items() if base is None or v[0] is base]:
+                self.discard(key)
+
+    @property
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return "{} hits, {} misses ({:.0%}), {} results in {:.1f} MB, {} evicted".format(self.hits, self.misses, self.hitRate, len(self.entries), self.total_bytes / 1e6, self.evictions)
+
+
+import select
+import errno
+import ctypes.util
+
+def copyNode(node): # Shallow copy sharing the children list, callers replace it before changing anything
+    copy = object.__new__(type(node))
+    for name in node.slotNames():
+        if hasattr(node, name):
+            setattr(copy, name, getattr(node, name))
+    return copy
+
+def copyPath(node, copies): # Copies node and its ancestors up to the root, every untouched child is shared with the old tree
+    # Parents of the old tree are followed until every target is in, shared children only move over in rescanStructure
+    copy = copies.get(id(node), None)
+    if copy is not None:
+        return copy
+    copy = copyNode(node)
+    copy.children = list(node.children)
+    copies[id(node)] = copy
+    if node.parent is not None:
+        parent_copy = copyPath(node.parent, copies)
+        parent_copy.children[parent_copy.children.index(node)] = copy
+        copy.parent = parent_copy
+    return copy
+
+def nodeDepth(node):
+    depth = 0
+    while node.parent is not None:
+        node = node.parent
+        depth += 1
+    return depth
+
+def rescanTarget(root, relative_path): # The deepest folder of the tree that still exists on disk along relative_path
+    node = root
+    for name in [x for x in relative_path.replace("\\", "/").split("/") if x and x != "."]:
+        child = next((x for x in node.children if x.name == name), None)
+        if child is None:
+            break
+        node = child
+    if node.file:
+        node = node.parent
+    while node.parent is not None and not os.path.isdir(node.path()):
+        node = node.parent
+    return node
+
+def rescanStructure(root, relative_paths, **kwargs):
+    # Rebuilds only the folders named in relative_paths and returns a new root. The old tree keeps its children, digests and paths so
+    # comparisons already running against it finish on a consistent snapshot, only the parents of children it shares with the new tree
+    # point into the new one. kwargs are passed to the StructureBuilder
+    targets = {}
+    for relative_path in relative_paths:
+        target = rescanTarget(root, relative_path)
+        targets[id(target)] = target
+    targets = list(targets.values())
+    target_ids = {id(x) for x in targets}
+    def covered(node): # Already rebuilt as part of an ancestor
+        node = node.parent
+        while node is not None:
+            if id(node) in target_ids:
+                return True
+            node = node.parent
+        return False
+    targets = [x for x in targets if not covered(x)]
+    if not targets:
+        return root
+    kwargs.setdefault("app_data", isinstance(root, AppDataStructure))
+    copies = {}
+    new_root = None
+    for target in targets:
+        replacement = copyNode(target)
+        replacement.children = NO_CHILDREN
+        if target.parent is None:
+            new_root = replacement
+        else:
+            parent_copy = copyPath(target.parent, copies)
+            parent_copy.children[parent_copy.children.index(target)] = replacement
+            replacement.parent = parent_copy
+        StructureBuilder(target.path(), replacement, **kwargs).run()
+    for copy in copies.values(): # Shared children move over to the new tree, so the next rescan walks up it and old trees can be freed. Their names are the same on both sides, so paths do not change
+        for child in copy.children:
+            child.parent = copy
+    for copy in sorted(copies.values(), key=nodeDepth, reverse=True): # Children before parents
+        copy.digest = folderDigest(copy)
+    return new_root or copies[id(root)]
+
+
+WATCH_DEBOUNCE = 1.0
+WATCH_POLL_INTERVAL = 2.0
+WATCH_POLL_RATIO = 20 # Polling waits at least this many times as long as a pass took, so a big tree is not scanned back to back
+
+def watchedName(name):
+    return name not in FILE_EXCEPTIONS and not name.endswith(PART_SUFFIX)
+
+class PollingWatcher: # Compares stat results of every folder on each pass, works everywhere
+    def __init__(self, location, interval=WATCH_POLL_INTERVAL):
+        self.location = location
+        self.interval = interval
+        self.scan_seconds = 0
+        self.snapshot = self.scan()
+
+    def scan(self): # relative folder path -> sorted (name, is folder, size, mtime_ns) of its entries
+        started = time.monotonic()
+        snapshot = {}
+        stack = [""]
+        while stack:
+            relative_path = stack.pop()
+            listing = []
+            try:
+                with os.scandir(os.path.join(self.location, relative_path)) as entries:
+                    for entry in entries:
+                        if not watchedName(entry.name):
+                            continue
+                        try:
+                            isdir = entry.is_dir()
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        listing.append((entry.name, isdir, 0 if isdir else stat.st_size, 0 if isdir else stat.st_mtime_ns))
+                        if isdir:
+                            stack.append(os.path.join(relative_path, entry.name))
+            except OSError:
+                continue
+            snapshot[relative_path] = sorted(listing)
+        self.scan_seconds = time.monotonic() - started
+        return snapshot
+
+    def wait(self, timeout): # Always a full interval, a pass without changes is what ends a burst
+        time.sleep(max(self.interval, self.scan_seconds * WATCH_POLL_RATIO))
+        snapshot = self.scan()
+        changed = {x for x in snapshot if self.snapshot.get(x, None) != snapshot[x]}
+        changed.update(os.path.dirname(x) for x in self.snapshot if x not in snapshot)
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher: # Linux only, one watch per folder since inotify is not recursive
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, location):
+        self.location = location
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {} # watch descriptor -> relative folder path
+        try:
+            self.addWatches("")
+        except OSError:
+            self.close()
+            raise
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith("linux")
+
+    def addWatches(self, relative_path): # Watches relative_path and every folder below it
+        stack = [relative_path]
+        while stack:
+            current = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.location, current)), self.MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOENT: # Gone again before it could be watched
+                    continue
+                if error == errno.EACCES:
+                    print("Cannot watch {}, changes inside it are not picked up".format(os.path.join(self.location, current)))
+                    continue
+                raise OSError(error, "inotify_add_watch failed for {}, fs.inotify.max_user_watches may be too low".format(os.path.join(self.location, current)))
+            self.watches[wd] = current
+            try:
+                with os.scandir(os.path.join(self.location, current)) as entries:
+                    stack.extend(os.path.join(current, x.name) for x in entries if watchedName(x.name) and x.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def wait(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self.fd, 64*1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, _, name_length = self.EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + name_length].rstrip(b"\x00"))
+            offset += self.EVENT.size + name_length
+            if mask & self.IN_Q_OVERFLOW: # Events were lost, only a full rescan is safe
+                changed.add("")
+                continue
+            relative_path = self.watches.get(wd, None)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if relative_path is None or (name and not watchedName(name)):
+                continue
+            if mask & self.IN_DELETE_SELF:
+                changed.add(os.path.dirname(relative_path))
+                continue
+            changed.add(relative_path)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.addWatches(os.path.join(relative_path, name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def watchBackend(requested): # --watch auto only watches where inotify is there, polling a whole install has to be asked for
+    if requested == "auto" and not InotifyWatcher.available():
+        return "off"
+    return requested
+
+class TreeWatcher(Thread):
+    # Collects the folders that changed below location and hands them to callback once no new change has arrived for
+    # debounce seconds, so a mod update writing hundreds of files causes one rescan instead of hundreds
+    def __init__(self, location, callback, backend="auto", debounce=WATCH_DEBOUNCE, poll_interval=WATCH_POLL_INTERVAL):
+        super(TreeWatcher, self).__init__(daemon=True)
+        assert backend in ("auto", "inotify", "poll"), "Unknown watch backend {}".format(backend)
+        self.location = location
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.stopped = False
+        self.backend = None
+        if backend != "poll" and InotifyWatcher.available():
+            try:
+                self.backend = InotifyWatcher(location)
+            except (OSError, AttributeError) as e:
+                if backend == "inotify":
+                    raise
+                print("Cannot watch {} through inotify ({}), polling instead".format(location, e))
+        if self.backend is None:
+            self.backend = PollingWatcher(location, poll_interval)
+
+    def changes(self):
+        try:
+            return self.backend.wait(self.debounce / 2)
+        except OSError as e: # inotify ran out of watches for a new folder, polling still sees everything
+            print("Watching {} through inotify failed ({}), polling instead".format(self.location, e))
+            self.backend.close()
+            self.backend = PollingWatcher(self.location, self.poll_interval)
+            return {""} # Whatever happened before the first pass is only caught by a full rescan
+
+    def run(self):
+        pending = set()
+        last_change = 0
+        while not self.stopped:
+            changed = self.changes()
+            if changed:
+                pending.update(changed)
+                last_change = time.monotonic()
+            elif pending and time.monotonic() - last_change >= self.debounce:
+                batch, pending = pending, set()
+                try:
+                    self.callback(batch)
+                except Exception as e:
+                    print("Rescan of {} failed: {}".format(self.location, e))
+        self.backend.close()
+
+    def stop(self):
+        self.stopped = True
+
+
+import math
+from contextlib import contextmanager
+
+class Histogram: # Buckets by power of two, enough to tell a 10 ms comparison from a 2 s one without keeping every sample
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {} # exponent -> count of values in [2**(exponent-1), 2**exponent)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        exponent = math.frexp(value)[1] if value > 0 else -1074
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def quantile(self, q): # Upper bound of the bucket holding the q-th value
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= q * self.count:
+                return min(math.ldexp(1, exponent), self.max)
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {"count" : 0}
+        return {"count" : self.count, "sum" : self.total, "min" : self.min, "max" : self.max, "mean" : self.total / self.count, "p50" : self.quantile(0.5), "p90" : self.quantile(0.9), "p99" : self.quantile(0.99)}
+
+class Metrics: # Counters, gauges and histograms by name, safe to update from any thread. Snapshots are plain dicts ready for json
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def adjust(self, name, value): # For gauges that go up and down, like active connections
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name, None)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_seconds" : time.time() - self.started,
+                "counters" : dict(self.counters),
+                "gauges" : dict(self.gauges),
+                "histograms" : {x : y.snapshot() for x, y in self.histograms.items()},
+            }
+
+    def dump(self, location, snapshot=None): # Replaced in one step so a reader never sees half a file
+        snapshot = snapshot or self.snapshot()
+        with open(location + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(location + ".tmp", location)
+
 
+class TokenBucket: # rate in bytes per second, up to burst bytes may go out at once. Sends may overdraw it and then wait off the debt
+    def __init__(self, rate, burst=None):
+        assert rate > 0
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
 
+    def reserve(self, size): # Takes size bytes out of the bucket, returns how many seconds to wait before sending them
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= size
+        return max(0.0, -self.tokens / self.rate)
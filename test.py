@@ -5,6 +5,7 @@ from main import clientSyncFiles
 
 import unittest
 import os
+import sys
 
 class TestFileComparison(unittest.TestCase):
     FILE_LOCATION = "test_files/"
@@ -51,6 +52,29 @@ class FileFolderTest(unittest.TestCase):
                         self.assertEqual(inner_file.relativePath(), r"test_files\text_case.txt")
                 break
 
+class CompactTreeTest(unittest.TestCase):
+    def test_no_instance_dict(self):
+        file = HashStructure("hi.txt", HashStructure("folder", isfile=False, defer_hash=True), isfile=True, defer_hash=True)
+        self.assertFalse(hasattr(file, "__dict__"))
+        self.assertIs(file.name, sys.intern("hi.txt"))
+    def test_pickle_drops_cached_paths(self):
+        import pickle
+        head = generateStructure("test_files/RimworldBase")
+        interior = [x for x in head.children if x.name == "Interior"][0]
+        self.assertEqual(interior.relativePath(), "Interior")
+        copy = pickle.loads(pickle.dumps(head))
+        self.assertIsNone([x for x in copy.children if x.name == "Interior"][0]._path)
+        self.assertEqual([x.relativePath() for x in getAllChildren(copy)], [x.relativePath() for x in getAllChildren(head)])
+        self.assertEqual([x.hash for x in getAllChildren(copy)], [x.hash for x in getAllChildren(head)])
+    def test_reparent_forgets_paths(self):
+        first = FileFolder("first", isfile=False)
+        second = FileFolder("second", isfile=False)
+        inner = FileFolder("inner", first, isfile=False)
+        deep = FileFolder("deep.txt", inner, isfile=True)
+        self.assertEqual(deep.path(), os.path.join("first", "inner", "deep.txt"))
+        second.setChild(inner)
+        self.assertEqual(deep.path(), os.path.join("second", "inner", "deep.txt"))
+
 class StructureGenerationTest(unittest.TestCase):
     def test(self):
         structure = "test_files"
@@ -219,6 +243,934 @@ class StructureComparisonTest(unittest.TestCase):
         to_download = clientSyncFiles(results['delete'], results['add'], results['modify'], testing=True)
         self.assertEqual(to_download[0].relativePath(), "different.txt")
 
+class DigestTest(unittest.TestCase):
+    FILE_LOCATION = "test_files/"
+
+    def test_identical_trees_match(self):
+        base = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldDifferentDeep"))
+        copy = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldDifferentDeep"))
+        self.assertTrue(structuresMatch(base, copy))
+        self.assertEqual(compareStructures(base, copy), {"delete" : [], "modify" : [], "add" : []})
+    def test_deep_change_reaches_root(self):
+        base = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldBase"))
+        different = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldDifferentDeep"))
+        self.assertFalse(structuresMatch(base, different))
+        base_interior = [x for x in base.children if x.name == "Interior"][0]
+        different_interior = [x for x in different.children if x.name == "Interior"][0]
+        self.assertNotEqual(base_interior.digest, different_interior.digest)
+        self.assertEqual([x.digest for x in base.children if x.file], [x.digest for x in different.children if x.file])
+    def test_matching_subtree_is_skipped(self):
+        base = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldBase"))
+        other = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldDifferentHi"))
+        interior = [x for x in other.children if x.name == "Interior"][0]
+        interior.children[0].hash = "tampered" # Only visible if compareStructures recurses
+        results = compareStructures(base, other)
+        self.assertEqual([x.relativePath() for x in results['modify']], ["hi.txt"])
+
+class ManifestTest(unittest.TestCase):
+    FILE_LOCATION = "test_files/"
+
+    def test_round_trip(self):
+        import pickle
+        base = generateStructure(os.path.join(self.FILE_LOCATION, "NonAsciiFileTest"))
+        manifest = b"".join(encodeManifest(structureEntries(base), base.digest))
+        entries, root_digest = decodeManifest(manifest)
+        rebuilt = structureFromManifest(entries, HashStructure(".", isfile=False, defer_hash=True), root_digest)
+        self.assertTrue(structuresMatch(base, rebuilt))
+        self.assertEqual(computeDigests(rebuilt), base.digest)
+        self.assertEqual(compareStructures(base, rebuilt), {"delete" : [], "modify" : [], "add" : []})
+        self.assertLess(len(manifest), len(pickle.dumps(base)) * 0.6)
+    def test_incremental_feed(self):
+        base = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldBase"))
+        manifest = b"".join(encodeManifest(structureEntries(base), base.digest))
+        reader = ManifestReader()
+        entries = []
+        for i in range(len(manifest)):
+            entries.extend(reader.feed(manifest[i:i+1]))
+        self.assertTrue(reader.done)
+        self.assertEqual(entries, decodeManifest(manifest)[0])
+        self.assertEqual([x.path for x in entries], ["Interior", "Interior/deep", "Interior/deep/hihi.txt", "Interior/empty", "Interior/hihi.txt", "bye.py", "hi.txt"])
+    def test_differences_round_trip(self):
+        base = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldBase"))
+        other = generateStructure(os.path.join(self.FILE_LOCATION, "RimworldMissingInterior"))
+        differences = compareStructures(base, other)
+        entries, _ = decodeManifest(b"".join(encodeManifest(differenceEntries(differences))))
+        rebuilt = differencesFromManifest(entries, HashStructure(".", isfile=False, defer_hash=True))
+        for section in ("delete", "modify", "add"):
+            self.assertEqual([x.relativePath() for x in rebuilt[section]], [x.relativePath() for x in differences[section]])
+            self.assertEqual([(x.file, x.hash) for x in rebuilt[section]], [(x.file, x.hash) for x in differences[section]])
+    def test_rejects_unsafe_paths(self):
+        for path in ["../outside.txt", "Mods/../../outside.txt", "/etc/passwd", "C:/Windows/evil.dll", "Mods\\..\\evil.dll", ""]:
+            manifest = b"".join(encodeManifest([ManifestEntry("structure", MANIFEST_FILE, path, 1, "00" * 32)]))
+            with self.assertRaises(ManifestError):
+                decodeManifest(manifest)
+    def test_rejects_garbage(self):
+        with self.assertRaises(ManifestError):
+            decodeManifest(b"\x80\x04garbage that is not a manifest")
+        manifest = b"".join(encodeManifest([ManifestEntry("structure", MANIFEST_FILE, "a.txt", 1, "00" * 32)]))
+        with self.assertRaises(ManifestError):
+            decodeManifest(manifest[:-5])
+    def test_algorithm_is_recorded(self):
+        entries = [ManifestEntry("structure", MANIFEST_FILE, "a.txt", 1, "ab" * 32)]
+        reader = ManifestReader()
+        reader.feed(b"".join(encodeManifest(entries, algorithm="blake2b")))
+        self.assertEqual(reader.algorithm, "blake2b")
+        with self.assertRaises(ManifestError):
+            checkManifestAlgorithm(reader)
+        version_1 = b"".join(encodeManifest(entries)).replace(MANIFEST_HEADER.pack(MANIFEST_MAGIC, MANIFEST_VERSION, 32) + b"\x06sha256", MANIFEST_HEADER.pack(MANIFEST_MAGIC, 1, 32))
+        reader = ManifestReader()
+        self.assertEqual(reader.feed(version_1), entries)
+        self.assertEqual(reader.algorithm, "sha256")
+
+class HashAlgorithmTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+        self.location = os.path.join(self.folder, "large.dll")
+        file = open(self.location, "wb")
+        file.write(os.urandom(MMAP_MIN_SIZE + 5))
+        file.close()
+    def tearDown(self):
+        from shutil import rmtree
+        setHashAlgorithm("sha256")
+        rmtree(self.folder)
+
+    def test_read_paths_agree(self):
+        import hashlib
+        expected = hashlib.sha256(open(self.location, "rb").read()).hexdigest()
+        self.assertEqual(hashFile(self.location, use_mmap=True), expected)
+        self.assertEqual(hashFile(self.location, use_mmap=False), expected)
+        self.assertEqual(hashFile(self.location), expected)
+        self.assertNotEqual(hashFile(self.location, "blake2b"), expected)
+    def test_large_files_are_not_mapped(self): # A file truncated under an mmap kills the process, one read short only hashes wrong
+        import hashlib
+        import rimlink
+        expected = hashlib.sha256(open(self.location, "rb").read()).hexdigest()
+        original = rimlink.mmap
+        rimlink.mmap = None
+        try:
+            self.assertEqual(hashFile(self.location), expected)
+        finally:
+            rimlink.mmap = original
+    def test_switching_algorithm_misses_cache(self):
+        cache = HashCache(os.path.join(self.folder, "hashes.cache"))
+        first = cache.hashFile(self.location)
+        setHashAlgorithm("blake2b")
+        second = cache.hashFile(self.location)
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(second), 64)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        cache.save()
+        cache = HashCache(cache.location).load()
+        self.assertEqual(cache.hashFile(self.location), second)
+        self.assertEqual(cache.hits, 1)
+        with self.assertRaises(ValueError):
+            setHashAlgorithm("md5")
+
+class LoopbackTestCase(unittest.TestCase): # Runs a real Server on an ephemeral port in a background event loop
+    HOST_LOCATION = "test_files/RimworldBase"
+
+    def setUp(self):
+        import asyncio
+        import threading
+        import main
+        self.main = main
+        self.loop = asyncio.new_event_loop()
+        self.server = main.Server()
+        self.server.base_structure = generateStructure(self.HOST_LOCATION)
+        self.server.base_app_data_structure = generateStructure("test_files/FakeAppData1")
+        started = threading.Event()
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            self.listener = self.loop.run_until_complete(asyncio.start_server(self.server._handle_client, "127.0.0.1", 0))
+            started.set()
+            self.loop.run_forever()
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        self.address = self.listener.sockets[0].getsockname()
+        self.old_address = (main.IP_ADDRESS, main.PORT)
+        main.IP_ADDRESS, main.PORT = self.address
+    def tearDown(self):
+        self.main.IP_ADDRESS, self.main.PORT = self.old_address
+        self.loop.call_soon_threadsafe(self.listener.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+    def connect(self):
+        import socket
+        s = socket.socket()
+        s.connect(self.address)
+        return s
+    def wait(self, coroutine):
+        return self.main.runConcurrently(coroutine)[0]
+    def hostDifferences(self, structure, root=".", codec=None):
+        return self.wait(self.main.AsyncClient(codec).differences(b"\x03", structure, HashStructure(root, isfile=False, defer_hash=True)))
+
+class ManifestComparisonTest(LoopbackTestCase):
+    def test_manifest_comparison(self):
+        other = generateStructure("test_files/RimworldMissingInterior")
+        differences = self.hostDifferences(other)
+        self.assertEqual(differences['delete'], [])
+        self.assertEqual(differences['modify'], [])
+        self.assertEqual(sorted(portablePath(x) for x in differences['add']), ["Interior", "Interior/deep", "Interior/deep/hihi.txt", "Interior/empty", "Interior/hihi.txt"])
+        self.assertEqual([x.path() for x in differences['add'] if x.name == "hihi.txt"], [os.path.join(".", "Interior", "deep", "hihi.txt"), os.path.join(".", "Interior", "hihi.txt")])
+    def test_hello_names_hash_algorithm(self):
+        self.assertEqual(self.wait(self.main.AsyncClient().hello({"hash" : ["sha256"]}))["hash"], "sha256")
+        reply = self.wait(self.main.AsyncClient().hello({"hash" : ["blake2b"]}))
+        self.assertIn("sha256", reply["error"]) # Turned away with a reason instead of failing every download later
+        s = self.connect()
+        s.send(b"\x03" + b"".join(encodeManifest(structureEntries(generateStructure(self.HOST_LOCATION)), algorithm="blake2b")))
+        self.assertEqual(s.recv(1), b"") # Refused rather than answered with every file as changed
+        s.close()
+    def test_pickle_opcodes_are_gone(self):
+        import pickle
+        for opcode in (b"\x00", b"\x01", b"\x02"): # Nothing from a peer is unpickled
+            s = self.connect()
+            payload = pickle.dumps(FileFolder("test_files/RimworldBase/hi.txt"))
+            s.sendall(opcode + len(payload).to_bytes(8, byteorder="big") + payload)
+            self.assertEqual(s.recv(1), b"")
+            s.close()
+    def test_rejected_manifest_closes_quietly(self):
+        s = self.connect()
+        s.send(b"\x03" + b"".join(encodeManifest([ManifestEntry("structure", MANIFEST_FILE, "../escape.txt", 1, "00" * 32)])))
+        self.assertEqual(s.recv(1), b"")
+        s.close()
+    def test_repeated_manifest_hits_diff_cache(self):
+        other = generateStructure("test_files/RimworldMissingInterior")
+        def compare():
+            differences = self.hostDifferences(other)
+            return sorted(portablePath(x) for x in differences['add'])
+        first = compare()
+        self.assertEqual(compare(), first)
+        self.assertEqual((self.server.diff_cache.hits, self.server.diff_cache.misses), (1, 1))
+        self.server.base_structure = generateStructure("test_files/RimworldMissingInterior")
+        self.assertEqual(compare(), [])
+        self.assertEqual(self.server.diff_cache.misses, 2)
+
+class OffloadTest(LoopbackTestCase):
+    def compare(self):
+        differences = self.hostDifferences(generateStructure("test_files/RimworldMissingInterior"))
+        return sorted(portablePath(x) for x in differences['add'] if x.file)
+    def test_slow_comparison_does_not_stall_others(self):
+        import time
+        import threading
+        original = self.main.manifestDifferenceChunks
+        def slow(*args):
+            time.sleep(1)
+            yield from original(*args)
+        self.main.manifestDifferenceChunks = slow
+        try:
+            comparing = threading.Thread(target=self.compare)
+            comparing.start()
+            time.sleep(.2)
+            t0 = time.perf_counter()
+            self.wait(self.main.AsyncClient().hello({}))
+            self.assertLess(time.perf_counter() - t0, .5)
+            comparing.join()
+        finally:
+            self.main.manifestDifferenceChunks = original
+        self.assertGreater(self.server.metrics.snapshot()["histograms"]["comparison_seconds/nextChunk"]["max"], 1)
+    def test_process_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        self.server.executor = ProcessPoolExecutor(max_workers=1)
+        try:
+            self.assertEqual(self.compare(), ["Interior/deep/hihi.txt", "Interior/hihi.txt"])
+        finally:
+            self.server.executor.shutdown()
+
+class RescanTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from shutil import copytree
+        self.folder = tempfile.mkdtemp()
+        self.location = os.path.join(self.folder, "base")
+        copytree("test_files/RimworldBase", self.location)
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def write(self, relative_path, contents):
+        file = open(os.path.join(self.location, relative_path), "w")
+        file.write(contents)
+        file.close()
+    def test_rescan_matches_full_scan(self):
+        from shutil import rmtree
+        old = generateStructure(self.location)
+        old_digest = old.digest
+        old_paths = [(x, x.relativePath()) for x in getAllChildren(old)]
+        old_interior = [x for x in old.children if x.name == "Interior"][0]
+        os.makedirs(os.path.join(self.location, "Interior", "deep", "new"))
+        self.write(os.path.join("Interior", "deep", "new", "added.txt"), "added")
+        self.write(os.path.join("Interior", "hihi.txt"), "changed")
+        rmtree(os.path.join(self.location, "Interior", "empty"), ignore_errors=True)
+        new = rescanStructure(old, [os.path.join("Interior", "deep"), "Interior", os.path.join("Interior", "empty")])
+        self.assertTrue(structuresMatch(new, generateStructure(self.location)))
+        self.assertEqual(old.digest, old_digest) # The old snapshot is untouched
+        self.assertEqual(computeDigests(old), old_digest)
+        untouched = [x for x in new.children if x.name != "Interior"]
+        self.assertTrue(untouched)
+        self.assertTrue(all(x in old.children for x in untouched)) # Shared, not rebuilt
+        self.assertTrue(all(x.parent is new for x in untouched))
+        for node in getAllChildren(new):
+            self.assertTrue(all(x.parent is node for x in node.children))
+        self.assertIs(old_interior.parent, old) # Replaced nodes stay with the old tree
+        self.assertTrue(all(x.relativePath() == path for x, path in old_paths))
+        self.assertEqual(sorted(x.relativePath() for x in getAllChildren(new)), sorted(x.relativePath() for x in getAllChildren(generateStructure(self.location))))
+    def test_rescan_of_sibling_folders(self):
+        structure = generateStructure(self.location)
+        for contents in ("first", "second"): # The second pass starts from the first one's tree
+            self.write(os.path.join("Interior", "deep", "hihi.txt"), contents)
+            self.write(os.path.join("Interior", "empty", "new.txt"), contents)
+            structure = rescanStructure(structure, [os.path.join("Interior", "deep"), os.path.join("Interior", "empty")])
+            self.assertTrue(structuresMatch(structure, generateStructure(self.location)))
+            for node in getAllChildren(structure):
+                self.assertTrue(all(x.parent is node for x in node.children))
+    def watch(self, backend):
+        import queue
+        seen = queue.Queue()
+        watcher = TreeWatcher(self.location, seen.put, backend, debounce=0.2, poll_interval=0.1)
+        watcher.start()
+        try:
+            for i in range(5): # One burst, one callback
+                self.write(os.path.join("Interior", "hihi.txt"), "burst {}".format(i))
+            self.write(PART_SUFFIX, "ignored")
+            changed = seen.get(timeout=10)
+            self.assertEqual(changed, {"Interior"})
+            self.assertTrue(seen.empty())
+        finally:
+            watcher.stop()
+            watcher.join()
+    def test_polling_watcher(self):
+        self.watch("poll")
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+    def test_inotify_watcher(self):
+        self.watch("inotify")
+    def test_polling_is_opt_in(self):
+        self.assertEqual(watchBackend("auto"), "auto" if sys.platform.startswith("linux") else "off")
+        self.assertEqual(watchBackend("poll"), "poll")
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+    def test_inotify_falls_back_to_polling(self):
+        import queue
+        seen = queue.Queue()
+        watcher = TreeWatcher(self.location, seen.put, "auto", debounce=0.2, poll_interval=0.1)
+        def addWatches(relative_path): # As if fs.inotify.max_user_watches ran out
+            raise OSError(28, "inotify_add_watch failed")
+        watcher.backend.addWatches = addWatches
+        watcher.start()
+        try:
+            os.makedirs(os.path.join(self.location, "Interior", "new"))
+            self.assertIn("", seen.get(timeout=10)) # Everything is rescanned once
+            self.assertIsInstance(watcher.backend, PollingWatcher)
+        finally:
+            watcher.stop()
+            watcher.join()
+
+class MetricsTest(LoopbackTestCase):
+    def test_stats_opcode_reports_transfers(self):
+        self.hostDifferences(generateStructure("test_files/RimworldMissingInterior"))
+        stats = self.wait(self.main.AsyncClient().stats())
+        self.assertEqual(stats["histograms"]["request_seconds/manifestComparison"]["count"], 1)
+        self.assertGreaterEqual(stats["gauges"]["active_connections"], 1) # At least the stats request itself
+        self.assertEqual(stats["diff_cache"]["misses"], 1)
+    def test_histogram(self):
+        metrics = Metrics()
+        for value in [0.001] * 90 + [1.5] * 10:
+            metrics.observe("seconds", value)
+        histogram = metrics.snapshot()["histograms"]["seconds"]
+        self.assertEqual(histogram["count"], 100)
+        self.assertLess(histogram["p50"], 0.002)
+        self.assertEqual(histogram["p99"], 1.5)
+
+class DiffCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        base = object()
+        cache = DiffCache(10)
+        cache.store("a", base, b"1234")
+        cache.store("b", base, b"1234")
+        self.assertEqual(cache.lookup("a", base), b"1234")
+        cache.store("c", base, b"1234")
+        self.assertIsNone(cache.lookup("b", base))
+        self.assertEqual(cache.lookup("a", base), b"1234")
+        self.assertEqual((cache.total_bytes, cache.evictions), (8, 1))
+        cache.store("huge", base, b"x" * 11)
+        self.assertNotIn("huge", cache.entries)
+    def test_stale_base_is_a_miss(self):
+        cache = DiffCache()
+        old, new = object(), object()
+        cache.store("a", old, b"diff")
+        self.assertIsNone(cache.lookup("a", new))
+        self.assertEqual((cache.total_bytes, cache.hits, cache.misses), (0, 0, 1))
+
+class BatchedFetchTest(LoopbackTestCase):
+    def setUp(self):
+        import tempfile
+        from shutil import copytree
+        super(BatchedFetchTest, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.client_location = os.path.join(self.folder, "client")
+        copytree("test_files/RimworldMissingInterior", self.client_location)
+        file = open(os.path.join(self.client_location, "hi.txt"), "w")
+        file.write("changed")
+        file.close()
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+        super(BatchedFetchTest, self).tearDown()
+
+    def differences(self):
+        return self.hostDifferences(generateStructure(self.client_location), self.client_location)
+    def test_sync_over_one_connection(self):
+        differences = self.differences()
+        self.assertEqual([x.name for x in differences['modify']], ["hi.txt"])
+        self.main.clientSyncFiles(differences['delete'], differences['add'], differences['modify'])
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+    def test_sync_over_several_connections(self):
+        differences = self.differences()
+        self.main.clientSyncFiles(differences['delete'], differences['add'], differences['modify'], connections=3)
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+    def test_large_file_streams_intact(self):
+        large = os.path.join(self.folder, "large.dll")
+        file = open(large, "wb")
+        file.write(os.urandom(3 * self.main.WRITE_BUFFER_LIMIT + 12345))
+        file.close()
+        self.server.base_structure = generateStructure(self.folder)
+        wanted = HashStructure("large.dll", HashStructure(self.client_location, isfile=False, defer_hash=True), isfile=True, size=0, defer_hash=True)
+        self.wait(self.main.AsyncClient().recieveFiles([wanted]))
+        self.assertTrue(compareFiles(large, wanted.path()))
+    def test_mismatched_download_is_discarded(self):
+        wanted = HashStructure("bye.py", HashStructure(self.client_location, isfile=False, defer_hash=True), isfile=True, size=0, defer_hash=True)
+        wanted.hash = "00" * 32
+        before = open(wanted.path(), "rb").read()
+        scheduler = self.main.DownloadScheduler(1)
+        scheduler.run([wanted])
+        self.assertEqual(scheduler.failed, [wanted])
+        self.assertEqual(open(wanted.path(), "rb").read(), before)
+        self.assertEqual([x for x in os.listdir(self.client_location) if x.endswith(PART_SUFFIX)], [])
+    def test_failed_download_keeps_modified_file(self):
+        differences = self.differences()
+        differences['modify'][0].hash = "00" * 32 # Whatever arrives cannot match
+        failed = self.main.clientSyncFiles(differences['delete'], differences['add'], differences['modify'])
+        self.assertEqual([x.name for x in failed], ["hi.txt"])
+        self.assertEqual(open(os.path.join(self.client_location, "hi.txt")).read(), "changed")
+    def test_verified_download_updates_hash_cache(self):
+        differences = self.differences()
+        cache = HashCache(os.path.join(self.folder, "hashes.cache"))
+        self.main.clientSyncFiles(differences['delete'], differences['add'], differences['modify'], hash_cache=cache)
+        structure = generateStructure(self.client_location, hash_cache=cache)
+        self.assertEqual(cache.misses, 1) # Only bye.py, which was never downloaded
+        self.assertTrue(structuresMatch(self.server.base_structure, structure))
+    def test_duplicate_content_is_fetched_once(self):
+        host = os.path.join(self.folder, "host")
+        self.client_location = os.path.join(self.folder, "dedup")
+        contents = {os.path.join("a", "0Harmony.dll") : b"harmony" * 1000, os.path.join("b", "0Harmony.dll") : b"harmony" * 1000, os.path.join("c", "0Harmony.dll") : b"harmony" * 1000, "texture.png" : b"png" * 500, os.path.join("moved", "keep.txt") : b"keep"}
+        local = {os.path.join("old", "keep.txt") : b"keep", "texture_old.png" : b"png" * 500}
+        for location, files in ((host, contents), (self.client_location, local)):
+            for name, data in files.items():
+                os.makedirs(os.path.dirname(os.path.join(location, name)), exist_ok=True)
+                file = open(os.path.join(location, name), "wb")
+                file.write(data)
+                file.close()
+        self.server.base_structure = generateStructure(host)
+        mine = generateStructure(self.client_location)
+        differences = self.differences()
+        plan = self.main.DedupPlan([x for x in differences['add'] if x.file], [mine])
+        self.assertEqual([x.name for x in plan.downloads()], ["0Harmony.dll"])
+        self.main.clientSyncFiles(differences['delete'], differences['add'], differences['modify'], local_structures=[mine])
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+        self.assertEqual(sorted(os.listdir(self.client_location)), ["a", "b", "c", "moved", "texture.png"]) # Staging folder is gone
+    def test_file_that_became_a_folder(self):
+        host = os.path.join(self.folder, "host")
+        self.client_location = os.path.join(self.folder, "kind")
+        for location, files in ((host, {os.path.join("D", "sub", "x.txt") : b"inside"}), (self.client_location, {os.path.join("D", "sub") : b"was a file"})):
+            for name, data in files.items():
+                os.makedirs(os.path.dirname(os.path.join(location, name)), exist_ok=True)
+                file = open(os.path.join(location, name), "wb")
+                file.write(data)
+                file.close()
+        self.server.base_structure = generateStructure(host)
+        mine = generateStructure(self.client_location)
+        differences = self.differences()
+        self.assertEqual(self.main.clientSyncFiles(differences['delete'], differences['add'], differences['modify'], local_structures=[mine]), [])
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+    def test_interrupted_download_resumes(self):
+        data = os.urandom(3 * RESUME_MIN_SIZE)
+        file = open(os.path.join(self.folder, "big.dll"), "wb")
+        file.write(data)
+        file.close()
+        self.server.base_structure = generateStructure(self.folder)
+        host = [x for x in self.server.base_structure.children if x.name == "big.dll"][0]
+        wanted = HashStructure("big.dll", HashStructure(self.client_location, isfile=False, defer_hash=True), isfile=True, size=len(data), defer_hash=True)
+        wanted.hash = host.hash
+        journal = TransferJournal(os.path.join(self.folder, "transfers.journal")).load()
+        class Dropping: # Hands over the first half of the file, then the connection goes away
+            def __init__(self):
+                self.left = data[:len(data) // 2]
+            async def recvInto(self, view):
+                size = min(len(view), len(self.left))
+                view[:size] = self.left[:size]
+                self.left = self.left[size:]
+                return size
+        with self.assertRaises(ConnectionResetError):
+            self.wait(self.main.AsyncClient(journal=journal).recieveVerifiedFile(Dropping(), wanted, len(data), bytearray(self.main.RECEIVE_BUFFER)))
+        journal = TransferJournal(journal.location).load() # As if the client was started again
+        self.assertEqual(journal.offset(wanted.path() + PART_SUFFIX, wanted.hash, len(data)), len(data) // 2)
+        scheduler = self.main.DownloadScheduler(1, journal=journal)
+        scheduler.run([wanted])
+        self.assertEqual((scheduler.failed, scheduler.files_resumed, scheduler.bytes_done), ([], 1, len(data) - len(data) // 2))
+        self.assertEqual(open(wanted.path(), "rb").read(), data)
+        self.assertEqual(TransferJournal(journal.location).load().entries, {})
+    def test_corrupt_part_starts_over(self):
+        data = os.urandom(RESUME_MIN_SIZE + 1)
+        file = open(os.path.join(self.folder, "big.dll"), "wb")
+        file.write(data)
+        file.close()
+        self.server.base_structure = generateStructure(self.folder)
+        wanted = HashStructure("big.dll", HashStructure(self.client_location, isfile=False, defer_hash=True), isfile=True, size=len(data), defer_hash=True)
+        wanted.hash = [x for x in self.server.base_structure.children if x.name == "big.dll"][0].hash
+        journal = TransferJournal(os.path.join(self.folder, "transfers.journal")).load()
+        file = open(wanted.path() + PART_SUFFIX, "wb")
+        file.write(b"garbage")
+        file.close()
+        journal.begin(wanted.path() + PART_SUFFIX, wanted.hash, len(data))
+        scheduler = self.main.DownloadScheduler(1, journal=journal)
+        scheduler.run([wanted])
+        self.assertEqual(scheduler.failed, [wanted])
+        self.assertFalse(os.path.exists(wanted.path() + PART_SUFFIX))
+        scheduler = self.main.DownloadScheduler(1, journal=journal)
+        scheduler.run([wanted])
+        self.assertEqual(open(wanted.path(), "rb").read(), data)
+    def test_modified_large_file_uses_delta(self):
+        host = os.path.join(self.folder, "host")
+        os.mkdir(host)
+        data = os.urandom(2 * DELTA_MIN_SIZE)
+        file = open(os.path.join(host, "Assembly.dll"), "wb")
+        file.write(data)
+        file.close()
+        file = open(os.path.join(self.client_location, "Assembly.dll"), "wb")
+        file.write(data[:1000] + b"older build" + data[1000:])
+        file.close()
+        self.server.base_structure = generateStructure(host)
+        differences = self.differences()
+        self.assertEqual([x.name for x in differences['modify']], ["Assembly.dll"])
+        self.main.clientSyncFiles(differences['delete'], differences['add'], differences['modify'])
+        self.assertTrue(compareFiles(os.path.join(host, "Assembly.dll"), os.path.join(self.client_location, "Assembly.dll")))
+        scheduler = self.main.DownloadScheduler(1)
+        file = open(os.path.join(self.client_location, "Assembly.dll"), "r+b")
+        file.write(b"corrupt")
+        file.close()
+        scheduler.run(differences['modify'], scheduler.downloadDeltas)
+        self.assertEqual((scheduler.delta_files, scheduler.failed), (1, []))
+        self.assertGreater(scheduler.bytes_saved, len(data) - 3 * deltaBlockSize(len(data)))
+        self.assertTrue(compareFiles(os.path.join(host, "Assembly.dll"), os.path.join(self.client_location, "Assembly.dll")))
+    def test_partition_by_size(self):
+        files = [HashStructure("{}.dll".format(size), isfile=True, size=size, defer_hash=True) for size in [1, 9, 5, 5, 10, 2]]
+        partitions = partitionBySize(files, 3)
+        self.assertEqual(sorted(sum(x.size for x in partition) for partition in partitions), [10, 11, 11])
+        self.assertEqual(len(partitionBySize(files[:2], 5)), 2)
+    def test_unknown_paths_are_refused(self):
+        wanted = HashStructure("secret.txt", HashStructure(self.client_location, isfile=False, defer_hash=True), isfile=True, size=0, defer_hash=True)
+        self.wait(self.main.AsyncClient().recieveFiles([wanted]))
+        self.assertFalse(os.path.exists(wanted.path()))
+
+class AsyncClientTest(LoopbackTestCase):
+    def setUp(self):
+        import tempfile
+        super(AsyncClientTest, self).setUp()
+        self.config_location = tempfile.mkdtemp() # A config folder that differs from the host's
+        for name, data in (("different.txt", "bad"), ("extra.txt", "only here")):
+            file = open(os.path.join(self.config_location, name), "w")
+            file.write(data)
+            file.close()
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.config_location)
+        super(AsyncClientTest, self).tearDown()
+
+    def test_concurrent_comparisons(self):
+        client = self.main.AsyncClient("zlib")
+        game, config, reply = self.main.runConcurrently(
+            client.differences(b"\x03", generateStructure("test_files/RimworldMissingInterior"), HashStructure(".", isfile=False, defer_hash=True)),
+            client.differences(b"\x04", generateStructure(self.config_location), HashStructure(".", isfile=False, defer_hash=True)),
+            client.hello({"compression" : ["zlib"]}))
+        self.assertEqual(sorted(portablePath(x) for x in game['add'] if x.file), ["Interior/deep/hihi.txt", "Interior/hihi.txt"])
+        self.assertEqual([x.name for x in config['modify']], ["different.txt"])
+        self.assertEqual([x.name for x in config['delete']], ["extra.txt"])
+        expected = compareStructures(self.server.base_app_data_structure, generateStructure(self.config_location))
+        self.assertEqual({x : len(y) for x, y in config.items()}, {x : len(y) for x, y in expected.items()})
+        self.assertEqual(reply["compression"], "zlib")
+        self.assertEqual(self.main.runConcurrently(client.stats())[0]["counters"]["connections"], 4)
+    def test_identical_comparisons_share_one_run(self):
+        import time
+        original = self.main.manifestDifferenceChunks
+        calls = []
+        def counted(*args): # Slow enough for every request to arrive while the first is still working
+            calls.append(args)
+            time.sleep(.3)
+            yield from original(*args)
+        self.main.manifestDifferenceChunks = counted
+        try:
+            client = self.main.AsyncClient()
+            structure = generateStructure("test_files/RimworldMissingInterior")
+            results = self.main.runConcurrently(*[client.differences(b"\x03", structure, HashStructure(".", isfile=False, defer_hash=True)) for i in range(4)])
+        finally:
+            self.main.manifestDifferenceChunks = original
+        self.assertEqual(len(calls), 1)
+        for differences in results:
+            self.assertEqual(sorted(portablePath(x) for x in differences['add'] if x.file), ["Interior/deep/hihi.txt", "Interior/hihi.txt"])
+        self.assertEqual(self.server.metrics.snapshot()["counters"]["shared_results"], 3)
+    def test_short_read_is_a_reset(self):
+        import asyncio
+        import socket
+        mine, theirs = socket.socketpair()
+        theirs.sendall(b"\x00\x00")
+        theirs.close()
+        async def shortStream():
+            mine.setblocking(False)
+            connection = self.main.ClientConnection(mine)
+            try:
+                await connection.readExactly(4)
+            finally:
+                connection.close()
+        with self.assertRaises(ConnectionResetError):
+            asyncio.run(shortStream())
+    def test_compressed_manifest_is_sent_as_it_is_encoded(self):
+        import asyncio
+        sent = []
+        class Recording:
+            async def send(self, data):
+                sent.append(data)
+        def chunks():
+            yield os.urandom(100000)
+            self.assertTrue(sent) # The first chunk is on its way before the second is made
+            yield os.urandom(100000)
+        asyncio.run(self.main.AsyncClient("zlib").sendFrames(Recording(), chunks()))
+        self.assertEqual(sent[-1], self.main.FRAME.pack(0))
+
+class TransferSchedulerTest(unittest.TestCase):
+    def test_slots_go_round_robin_between_clients(self):
+        import asyncio
+        import main
+        order = []
+        async def run():
+            scheduler = main.TransferScheduler(max_transfers=1)
+            await scheduler.admit("a")
+            async def transfer(peer):
+                await scheduler.admit(peer)
+                order.append(peer)
+                await asyncio.sleep(0)
+                scheduler.release()
+            tasks = [asyncio.ensure_future(transfer(x)) for x in ["a", "a", "a", "b", "c"]]
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.metrics.gauges["transfers_queued"], 5)
+            scheduler.release()
+            await asyncio.gather(*tasks)
+            self.assertEqual(scheduler.active, 0)
+        asyncio.run(run())
+        self.assertEqual(order, ["a", "b", "c", "a", "a"])
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.reserve(1000), 0)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, places=2)
+
+class ThrottledFetchTest(LoopbackTestCase):
+    def test_client_limit_slows_transfer(self):
+        import time
+        import tempfile
+        from shutil import rmtree
+        folder = tempfile.mkdtemp()
+        try:
+            data = os.urandom(300 * 1024)
+            file = open(os.path.join(folder, "big.dll"), "wb")
+            file.write(data)
+            file.close()
+            self.server.base_structure = generateStructure(folder)
+            self.server.transfers = self.main.TransferScheduler(2, 0, 200 * 1024, self.server.metrics)
+            client = os.path.join(folder, "client")
+            os.mkdir(client)
+            wanted = HashStructure("big.dll", HashStructure(client, isfile=False, defer_hash=True), isfile=True, size=0, defer_hash=True)
+            t0 = time.perf_counter()
+            self.wait(self.main.AsyncClient().recieveFiles([wanted]))
+            self.assertGreater(time.perf_counter() - t0, 0.3) # 200 KB of burst, then 100 KB at 200 KB/s
+            self.assertEqual(open(wanted.path(), "rb").read(), data)
+            self.assertGreater(self.server.metrics.snapshot()["histograms"]["throttle_wait_seconds"]["max"], 0.3)
+        finally:
+            rmtree(folder)
+
+class StreamingSyncTest(LoopbackTestCase):
+    def setUp(self):
+        import tempfile
+        from shutil import copytree
+        super(StreamingSyncTest, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.client_location = os.path.join(self.folder, "client")
+        copytree("test_files/RimworldMissingInterior", self.client_location)
+        for name, data in (("hi.txt", "changed"), ("extra.txt", "not on the host"), ("Interior", "a file where the host has a folder")):
+            file = open(os.path.join(self.client_location, name), "w")
+            file.write(data)
+            file.close()
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+        super(StreamingSyncTest, self).tearDown()
+
+    def sync(self, codec=None):
+        mine = generateStructure(self.client_location)
+        return self.main.clientStreamSync([(b"\x03", mine, HashStructure(self.client_location, isfile=False, defer_hash=True))], codec=codec, connections=2)
+    def test_stream_sync(self):
+        self.assertEqual(self.sync(), [])
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+    def test_compressed_stream_sync(self):
+        self.assertEqual(self.sync("zlib"), [])
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+    def test_downloads_start_before_comparison_ends(self):
+        import time
+        import threading
+        original = self.main.manifestDifferenceChunks
+        end_size = MANIFEST_RECORD.size + 32
+        def stalled(*args): # Every entry straight away, the end of the manifest a second later
+            encoded = b"".join(original(*args))
+            yield encoded[:-end_size]
+            yield b""
+            time.sleep(1)
+            yield encoded[-end_size:]
+        self.main.manifestDifferenceChunks = stalled
+        try:
+            syncing = threading.Thread(target=self.sync)
+            syncing.start()
+            target = os.path.join(self.client_location, "Interior", "deep", "hihi.txt")
+            deadline = time.time() + .8
+            while not os.path.exists(target) and time.time() < deadline:
+                time.sleep(.01)
+            self.assertTrue(os.path.exists(target))
+            self.assertTrue(syncing.is_alive())
+            self.assertTrue(os.path.exists(os.path.join(self.client_location, "extra.txt"))) # Deletes wait for the end
+            syncing.join()
+        finally:
+            self.main.manifestDifferenceChunks = original
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+    def test_overwritten_source_is_staged_and_copied_off_the_loop(self):
+        import threading
+        host = os.path.join(self.folder, "host")
+        self.client_location = os.path.join(self.folder, "swap")
+        for location, files in ((host, {"a.txt" : "alpha", "b.txt" : "beta"}), (self.client_location, {"a.txt" : "beta"})): # a.txt is overwritten before b.txt asks for its old content
+            os.makedirs(location)
+            for name, data in files.items():
+                file = open(os.path.join(location, name), "w")
+                file.write(data)
+                file.close()
+        self.server.base_structure = generateStructure(host)
+        copies = []
+        original = self.main.DedupPlan.copy
+        def copy(source, fileObj, hardlinks=False):
+            copies.append((fileObj.name, threading.current_thread() is threading.main_thread()))
+            return original(source, fileObj, hardlinks)
+        self.main.DedupPlan.copy = staticmethod(copy)
+        try:
+            self.assertEqual(self.sync(), [])
+        finally:
+            self.main.DedupPlan.copy = staticmethod(original)
+        self.assertEqual(copies, [("b.txt", False)])
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+        self.assertEqual(sorted(os.listdir(self.client_location)), ["a.txt", "b.txt"]) # Staging folder is gone
+    def test_lazy_scan_hashes_only_same_size_files(self):
+        file = open(os.path.join(self.client_location, "bye.py"), "w")
+        file.write("x" * os.path.getsize("test_files/RimworldBase/bye.py")) # Same size as the host's, only hashing tells them apart
+        file.close()
+        host, = self.main.runConcurrently(self.main.AsyncClient("zlib").hostStructure(self.main.AREA_GAME, HashStructure(self.client_location, isfile=False, defer_hash=True)))
+        self.assertEqual(host.digest, self.server.base_structure.digest)
+        engine = HashingEngine()
+        mine = generateStructure(self.client_location, hashing_engine=engine, expected_sizes=fileSizes(host))
+        self.assertEqual((engine.files_hashed, engine.files_settled), (1, 3)) # bye.py, then hi.txt, extra.txt and the Interior file
+        self.assertEqual(self.main.clientStreamSync([], local_differences=[self.main.lazyDifferences(host, mine)], local_structures=[mine], connections=2), [])
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+
+class ApplyPlanTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+        for path in ("old/inner/a.txt", "old/b.txt", "keep/c.txt", "keep/d.txt"):
+            os.makedirs(os.path.dirname(os.path.join(self.folder, path)), exist_ok=True)
+            file = open(os.path.join(self.folder, path), "w")
+            file.write(path)
+            file.close()
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def test_deletes_inside_deleted_folders_are_skipped(self):
+        import main
+        mine = generateStructure(self.folder)
+        nodes = {x.relativePath().replace(os.sep, "/") : x for x in getAllChildren(mine)}
+        removed = []
+        original = main.ApplyPlan.remove
+        main.ApplyPlan.remove = staticmethod(lambda path: removed.append(path) or original(path))
+        try:
+            main.ApplyPlan(workers=4).delete([nodes["old/inner/a.txt"], nodes["old"], nodes["old/inner"], nodes["keep/d.txt"]])
+        finally:
+            main.ApplyPlan.remove = staticmethod(original)
+        self.assertEqual(sorted(removed), sorted([nodes["old"].path(), nodes["keep/d.txt"].path()]))
+        self.assertEqual(sorted(os.listdir(self.folder)), ["keep"])
+        self.assertEqual(os.listdir(os.path.join(self.folder, "keep")), ["c.txt"])
+    def test_folders_are_made_under_their_parents(self):
+        import main
+        wanted = ["new", "new/deep", "new/deep/er", "new/side", "keep/sub"] + ["wide/{}".format(i) for i in range(200)]
+        entries = [ManifestEntry("add", MANIFEST_FOLDER, x, 0, None) for x in sorted(wanted + ["wide"], reverse=True)] # Children before parents
+        entries.append(ManifestEntry("add", MANIFEST_FILE, "new/deep/file.txt", 1, None))
+        root = HashStructure(self.folder, isfile=False, defer_hash=True)
+        nodes = [node for _, node in ManifestTree(root).add(entries)]
+        main.ApplyPlan(workers=8).makeFolders(nodes)
+        for path in wanted:
+            self.assertTrue(os.path.isdir(os.path.join(self.folder, path)))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, "new/deep/file.txt")))
+
+class CompressionTest(LoopbackTestCase):
+    def setUp(self):
+        import tempfile
+        from shutil import copytree
+        super(CompressionTest, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.client_location = os.path.join(self.folder, "client")
+        copytree("test_files/RimworldMissingInterior", self.client_location)
+        file = open(os.path.join(self.client_location, "hi.txt"), "w")
+        file.write("changed")
+        file.close()
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+        super(CompressionTest, self).tearDown()
+
+    def hello(self, offered):
+        return self.wait(self.main.AsyncClient().hello({"compression" : offered})).get("compression", None)
+    def test_negotiation(self):
+        self.assertEqual(self.hello(["zlib"]), "zlib")
+        self.assertIsNone(self.hello([]))
+        self.assertIsNone(self.hello(["lz4-unknown"]))
+    def test_compressed_sync(self):
+        codec = self.hello(["zlib"])
+        differences = self.hostDifferences(generateStructure(self.client_location), self.client_location, codec)
+        self.assertEqual([x.name for x in differences['modify']], ["hi.txt"])
+        self.main.clientSyncFiles(differences['delete'], differences['add'], differences['modify'], codec=codec)
+        self.assertTrue(structuresMatch(self.server.base_structure, generateStructure(self.client_location)))
+    def test_codec_prefix_only_for_compressed_opcodes(self):
+        for opcode in (b"\x06", b"\x07", b"\x09", b"\x0a"):
+            s = self.connect()
+            s.sendall(b"\x08" + bytes([len("zlib")]) + b"zlib" + opcode + self.main.FRAME.pack(2) + b"{}")
+            self.assertEqual(s.recv(1), b"") # Closed instead of failing inside the handler
+            s.close()
+        self.assertEqual(self.server.metrics.snapshot()["counters"]["rejected_requests"], 4)
+    def test_compressible_file_shrinks_and_media_is_skipped(self):
+        for name, data in [("big.xml", b"<Defs><ThingDef/></Defs>\n" * 20000), ("image.png", os.urandom(4096))]:
+            file = open(os.path.join(self.folder, name), "wb")
+            file.write(data)
+            file.close()
+        self.server.base_structure = generateStructure(self.folder)
+        root = HashStructure(self.client_location, isfile=False, defer_hash=True)
+        wanted = [HashStructure(x, root, isfile=True, size=0, defer_hash=True) for x in ("big.xml", "image.png")]
+        before = self.main.COMPRESSION_STATS.wire_bytes
+        self.wait(self.main.AsyncClient("zlib").recieveFiles(wanted))
+        self.assertLess(self.main.COMPRESSION_STATS.wire_bytes - before, 20000) # Only the xml went through zlib
+        self.assertTrue(shouldCompress("big.xml", 20000))
+        self.assertFalse(shouldCompress("image.png", 4096))
+        for x in wanted:
+            self.assertTrue(compareFiles(os.path.join(self.folder, x.name), x.path()))
+
+    def test_compression_runs_off_the_loop(self):
+        import threading
+        threads = set()
+        original = self.server.compression_stats.compressor
+        def compressor(codec):
+            inner = original(codec)
+            class Recording:
+                def compress(self, data):
+                    threads.add(threading.get_ident())
+                    return inner.compress(data)
+                def flush(self):
+                    return inner.flush()
+            return Recording()
+        self.server.compression_stats.compressor = compressor
+        file = open(os.path.join(self.folder, "big.xml"), "wb")
+        file.write(b"<Defs><ThingDef/></Defs>\n" * 20000)
+        file.close()
+        self.server.base_structure = generateStructure(self.folder)
+        wanted = HashStructure("big.xml", HashStructure(self.client_location, isfile=False, defer_hash=True), isfile=True, size=0, defer_hash=True)
+        self.wait(self.main.AsyncClient("zlib").recieveFiles([wanted]))
+        self.assertTrue(compareFiles(os.path.join(self.folder, "big.xml"), wanted.path()))
+        self.assertTrue(threads)
+        self.assertNotIn(self.thread.ident, threads)
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+        self.old = os.path.join(self.folder, "old.dll")
+        self.new = os.path.join(self.folder, "new.dll")
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+    def rebuild(self, old_data, new_data, block_size=4096):
+        import io
+        file = open(self.old, "wb")
+        file.write(old_data)
+        file.close()
+        file = open(self.new, "wb")
+        file.write(new_data)
+        file.close()
+        instructions = list(computeDelta(self.new, block_size, blockSignatures(self.old, block_size), len(old_data)))
+        rebuilt = io.BytesIO()
+        with open(self.old, "rb") as source:
+            applyDelta(source, instructions, block_size, rebuilt)
+        self.assertEqual(rebuilt.getvalue(), new_data)
+        return sum(len(value) for kind, value in instructions if kind == "data")
+
+    def test_small_edit_sends_little(self):
+        data = os.urandom(300000)
+        self.assertEqual(self.rebuild(data, data), 0)
+        self.assertLess(self.rebuild(data, data[:150000] + b"patched" + data[150000:]), 2 * 4096)
+        self.assertLess(self.rebuild(data, data[:1000] + data[2000:]), 4096)
+        self.assertEqual(self.rebuild(data, data[:-10]), 300000 % 4096 - 10)
+    def test_edge_cases(self):
+        data = os.urandom(10000)
+        self.assertEqual(self.rebuild(b"", data), 10000)
+        self.assertEqual(self.rebuild(data, b""), 0)
+        self.assertEqual(self.rebuild(data[:4096], data[:4096]), 0)
+        self.assertEqual(self.rebuild(data, os.urandom(50)), 50)
+    def test_batches_are_bounded_by_bytes(self):
+        import main
+        file = open(self.new, "wb")
+        file.write(os.urandom(3 * main.FILE_CHUNK + 10))
+        file.close()
+        instructions = computeDelta(self.new, 4096, [], 0) # Nothing to copy from, every byte is literal
+        sizes = []
+        batch = main.deltaBatch(instructions)
+        while batch:
+            sizes.append(sum(len(value) for kind, value in batch))
+            batch = main.deltaBatch(instructions)
+        self.assertEqual(sum(sizes), 3 * main.FILE_CHUNK + 10)
+        self.assertLessEqual(max(sizes), main.FILE_CHUNK + DELTA_LITERAL_LIMIT)
+        self.assertGreaterEqual(len(sizes), 3)
+    def test_truncated_file_is_an_error(self):
+        data = os.urandom(3 * DELTA_READ)
+        for location in (self.old, self.new):
+            file = open(location, "wb")
+            file.write(data)
+            file.close()
+        instructions = computeDelta(self.new, 4096, blockSignatures(self.old, 4096), len(data))
+        self.assertEqual(next(instructions), ("copy", 0))
+        os.truncate(self.new, 8192) # As if the mod was rewritten meanwhile
+        with self.assertRaises(OSError):
+            list(instructions)
+    def test_rolling_checksum_is_adler32(self):
+        import zlib
+        data = os.urandom(5000)
+        block_size = 1024
+        adler = zlib.adler32(data[:block_size])
+        a, b = adler & 0xFFFF, adler >> 16
+        for pos in range(200):
+            a = (a - data[pos] + data[pos + block_size]) % ADLER_MOD
+            b = (b - block_size * data[pos] + a - 1) % ADLER_MOD
+            self.assertEqual((b << 16) | a, zlib.adler32(data[pos + 1:pos + 1 + block_size]))
+
 class IsFileTest(unittest.TestCase):
     def test_is_file(self):
         self.assertTrue(FileFolder("test_files\\dll_case.dll").file)
@@ -242,6 +1194,104 @@ class IsFileTest(unittest.TestCase):
             elif "Player.log" in child.name:
                 self.assertTrue(child.file)
 
+class HashCacheTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+        self.cache_location = os.path.join(self.folder, "hashes.cache")
+        self.file = os.path.join(self.folder, "cached.txt")
+        file = open(self.file, "w")
+        file.write("first")
+        file.close()
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.folder)
+
+    def test_hit_after_reload(self):
+        cache = HashCache(self.cache_location)
+        self.assertEqual(cache.hashFile(self.file), hashFile(self.file))
+        cache.save()
+        reloaded = HashCache(self.cache_location).load()
+        self.assertEqual(reloaded.hashFile(self.file), hashFile(self.file))
+        self.assertEqual((cache.misses, reloaded.hits, reloaded.misses), (1, 1, 0))
+    def test_changed_file_is_rehashed(self):
+        cache = HashCache(self.cache_location)
+        cache.hashFile(self.file)
+        file = open(self.file, "w")
+        file.write("second, longer")
+        file.close()
+        self.assertEqual(cache.hashFile(self.file), hashFile(self.file))
+        self.assertEqual(cache.misses, 2)
+    def test_invalidate_and_compact(self):
+        cache = HashCache(self.cache_location)
+        cache.hashFile(self.file)
+        cache.save()
+        self.assertEqual(cache.invalidate(self.folder), 1)
+        cache.save()
+        self.assertEqual(HashCache(self.cache_location).load().entries, {})
+        cache.hashFile(self.file)
+        cache.compact()
+        self.assertEqual(len(HashCache(self.cache_location).load().entries), 1)
+        self.assertEqual(cache.logged, 1)
+    def test_structure_uses_cache(self):
+        cache = HashCache(self.cache_location)
+        first = generateStructure(self.folder, hash_cache=cache)
+        second = generateStructure(self.folder, hash_cache=cache)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual([x.hash for x in getAllChildren(first)], [x.hash for x in getAllChildren(second)])
+    def test_walk_entries_match_os_stat(self):
+        cache = HashCache(self.cache_location)
+        generateStructure(self.folder, hash_cache=cache)
+        self.assertEqual(cache.hashFile(self.file), hashFile(self.file))
+        self.assertEqual(cache.hits, 1)
+        cache.compact()
+        self.assertEqual(list(cache.entries), [os.path.abspath(self.file)])
+
+class HashingEngineTest(unittest.TestCase):
+    FILE_LOCATION = "test_files/RimworldBase"
+
+    def hashes(self, structure):
+        return {x.relativePath() : x.hash for x in getAllChildren(structure)}
+    def test_backends_agree(self):
+        inline = generateStructure(self.FILE_LOCATION, hashing_engine=HashingEngine(workers=1))
+        threads = generateStructure(self.FILE_LOCATION, hashing_engine=HashingEngine("thread", 4, 1))
+        processes = generateStructure(self.FILE_LOCATION, hashing_engine=HashingEngine("process", 2, 1))
+        self.assertEqual(self.hashes(inline), self.hashes(threads))
+        self.assertEqual(self.hashes(inline), self.hashes(processes))
+        self.assertEqual(self.hashes(inline)[os.path.join("Interior", "hihi.txt")], hashFile(os.path.join(self.FILE_LOCATION, "Interior", "hihi.txt")))
+    def test_batches_split_on_bytes(self):
+        engine = HashingEngine(batch_size=10)
+        small = HashStructure("small.txt", isfile=True, size=1, defer_hash=True)
+        large = HashStructure("large.dll", isfile=True, size=HashingEngine.BATCH_BYTES, defer_hash=True)
+        batches = list(engine.batches([(small, None), (large, None), (small, None)]))
+        self.assertEqual([len(x) for x in batches], [2, 1])
+    def test_largest_files_hash_first(self):
+        engine = HashingEngine(workers=1, batch_size=1)
+        order = []
+        engine.finishBatch = lambda batch, digests, hash_cache: order.append(batch[0][0].size)
+        files = [HashStructure(os.path.join(self.FILE_LOCATION, "hi.txt"), isfile=True, size=size, defer_hash=True) for size in [3, 10, 1, 7]]
+        engine.hashStructures([(x, None) for x in files])
+        self.assertEqual(order, [10, 7, 3, 1])
+    def test_walk_errors_are_raised(self):
+        with self.assertRaises(FileNotFoundError): # Used to leave the builder polling forever
+            generateStructure("test_files/DoesNotExist", HashStructure("DoesNotExist", isfile=False, defer_hash=True))
+
+class BenchmarkTest(unittest.TestCase):
+    def test_tiny_benchmark_runs(self):
+        import tempfile
+        from shutil import rmtree
+        import benchmark
+        location = tempfile.mkdtemp()
+        try:
+            generator = benchmark.TreeGenerator(mods=3, files=30, depth=2, seed=4)
+            self.assertEqual(list(generator.layout()), list(benchmark.TreeGenerator(mods=3, files=30, depth=2, seed=4).layout()))
+            report = benchmark.runBenchmarks(location, generator, repeat=1)
+        finally:
+            rmtree(location)
+        self.assertEqual(report["tree"]["files"], 30)
+        self.assertEqual(report["results"]["loopback_sync"]["failed"], 0)
+        self.assertGreater(report["results"]["compare_structures"]["add"], 0)
+
 class SpeedTests(unittest.TestCase):
     def test_speed_of_generate_tree_and_compare_tree(self):
         from shutil import rmtree